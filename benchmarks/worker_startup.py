@@ -0,0 +1,105 @@
+#####################################################################
+#                                                                   #
+# /benchmarks/worker_startup.py                                     #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Benchmark of analysis worker startup
+
+Measures, in fresh interpreters, how long analysis_subprocess.py takes to import
+what it needs before connecting to the lyse parent process (which is how long
+the parent waits when starting a worker), and how long the imports it does
+afterwards take (which a pooled worker does whilst waiting for a routine). Also
+measures the cost of importing pyplot, which workers now only pay for routines
+that plot.
+
+Usage::
+
+    python benchmarks/worker_startup.py [--repeats N] [--max-seconds T]
+
+With --max-seconds, exits with status 1 if the median time to reach the
+connection exceeds T, for use as a regression check.
+"""
+
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+ANALYSIS_SUBPROCESS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lyse', 'analysis_subprocess.py'
+)
+
+# Run in a fresh interpreter, printing the elapsed time. Running the worker script
+# under a name other than '__main__' executes everything up to the connection to
+# the parent, but not the __main__ block:
+PRE_CONNECTION = """
+import time, runpy
+start = time.perf_counter()
+runpy.run_path({path!r}, run_name='analysis_subprocess')
+print(time.perf_counter() - start)
+"""
+
+POST_CONNECTION = """
+import time, runpy
+runpy.run_path({path!r}, run_name='analysis_subprocess')
+start = time.perf_counter()
+import labscript_utils.h5_lock, h5py
+import desktop_app
+import multiprocessing
+import lyse.utils
+import lyse.utils.worker
+import lyse.utils.shot_cache
+import lyse.figure_manager
+print(time.perf_counter() - start)
+"""
+
+PYPLOT = """
+import time, runpy
+runpy.run_path({path!r}, run_name='analysis_subprocess')
+import lyse.figure_manager
+start = time.perf_counter()
+import matplotlib.pyplot
+print(time.perf_counter() - start)
+"""
+
+
+def time_snippet(snippet, repeats):
+    env = dict(os.environ, MPLBACKEND='qt5agg')
+    times = []
+    for _ in range(repeats):
+        output = subprocess.check_output(
+            [sys.executable, '-c', snippet.format(path=ANALYSIS_SUBPROCESS)], env=env
+        )
+        times.append(float(output.decode().strip().splitlines()[-1]))
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=None)
+    args = parser.parse_args()
+
+    pre_connection = time_snippet(PRE_CONNECTION, args.repeats)
+    post_connection = time_snippet(POST_CONNECTION, args.repeats)
+    pyplot = time_snippet(PYPLOT, args.repeats)
+    print('median of {} runs:'.format(args.repeats))
+    print('  imports before connecting to parent: {:.3f} s'.format(pre_connection))
+    print('  imports after connecting to parent:  {:.3f} s'.format(post_connection))
+    print('  importing pyplot on first use:       {:.3f} s'.format(pyplot))
+
+    if args.max_seconds is not None and pre_connection > args.max_seconds:
+        print('FAIL: connecting took longer than {} s'.format(args.max_seconds))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
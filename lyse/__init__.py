@@ -19,6 +19,9 @@ import sys
 import functools
 import contextlib
 import warnings
+import tempfile
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 
 import labscript_utils.h5_lock, h5py
 import pandas
@@ -35,6 +38,7 @@ from labscript_utils.properties import get_attributes, get_attribute, set_attrib
 # lyse imports
 import lyse.dataframe_utilities
 import lyse.utils
+import lyse.utils.shot_cache
 
 # Import this way so LYSE_DIR is exposed when someone does import lyse or from lyse import *
 from lyse.utils import LYSE_DIR
@@ -50,6 +54,8 @@ __all__ = [
     'routine_storage',
     'data',
     'globals_diff',
+    'sequence_globals_diff',
+    'get_image_stack',
     'open_file',
     'Run',
     'Sequence',
@@ -129,6 +135,20 @@ def data(filepath=None, host='localhost', port=lyse.utils.LYSE_PORT, timeout=5,
             instead return a section of the lyse dataframe. Note that if
             `filepath` is not None, then the other arguments will be ignored.
             Defaults to `None`.
+
+            If ``send_shot_data_to_workers = True`` is set in the ``[lyse]``
+            section of the labconfig, then when called from a single-shot
+            routine running in lyse with `filepath` set to the shot being
+            analysed, the values are instead taken from the shot's row of the
+            lyse dataframe, which lyse sends to the routine along with the shot,
+            so that the file need not be read. Results saved to the shot by
+            earlier routines and by this routine so far are included. This
+            differs from reading the file in that numeric values have the dtype
+            of their column in the dataframe, so integers may be returned as
+            floats if the column has missing values for other shots, and values
+            that are NaN in the file are omitted, as they cannot be told apart
+            from columns holding data for other shots only. Defaults to reading
+            the file.
         host (str, optional): The address of the computer running lyse. Defaults
             to `'localhost'`.
         port (int, optional): The port on which lyse is listening. Defaults to
@@ -164,6 +184,13 @@ def data(filepath=None, host='localhost', port=lyse.utils.LYSE_PORT, timeout=5,
         the lyse dataframe, or a subset of it, is returned.
     """    
     if filepath is not None:
+        shot_data = lyse.utils.worker._shot_data
+        if shot_data is not None and filepath == lyse.utils.worker.path:
+            # Running in lyse on this shot, which sent us its row of the dataframe.
+            # Add results saved by this routine so far, as those would be in the file:
+            flat_dict = dict(shot_data)
+            flat_dict.update(lyse.utils.worker._updated_data.get(filepath, {}))
+            return lyse.dataframe_utilities.flat_dict_to_flat_series(flat_dict)
         return lyse.dataframe_utilities.get_series_from_shot(filepath)
     else:
         if n_sequences is not None:
@@ -216,7 +243,166 @@ def globals_diff(run1, run2, group=None):
         `key:['-',val2]`.
     """
     return dict_diff(run1.get_globals(group), run2.get_globals(group))
- 
+
+def sequence_globals_diff(runs, group=None):
+    """Find the globals that vary across many runs, and the values they take.
+
+    This is the many-run counterpart to :obj:`globals_diff`, intended for
+    finding which globals were scanned over in a sequence. Given `Run` objects,
+    their (cached) globals are collected into a table with one row per run;
+    given the lyse dataframe, its globals columns are used directly and no
+    files are opened. Each column is then checked for distinct values in a
+    single pass.
+
+    Args:
+        runs (:obj:`Sequence`, iterable of :obj:`Run`, or :obj:`pandas:pandas.DataFrame`):
+            The runs to compare. A `Sequence` compares the runs it contains. A
+            dataframe is interpreted as (part of) the lyse dataframe, such as
+            returned by :obj:`data`.
+        group (str, optional): When `None` (default), compare all globals.
+            Otherwise, only compare globals in `group`. Cannot be used with a
+            dataframe, which does not record which group each global is in.
+
+    Raises:
+        ValueError: If `group` is given along with a dataframe.
+
+    Returns:
+        dict: Dictionary of the globals that do not have the same value in all
+        runs, in the form `key:[val1,val2,...]` listing each distinct value once
+        in order of first appearance. Runs missing a global altogether
+        contribute a `NaN` value for it.
+    """
+    if isinstance(runs, pandas.DataFrame):
+        if group is not None:
+            raise ValueError('Cannot compare a single globals group of a dataframe')
+        columns = lyse.dataframe_utilities.get_globals_columns(runs)
+        table = pandas.DataFrame({
+            column[0] if isinstance(column, tuple) else column: runs[column]
+            for column in columns
+        })
+    else:
+        if isinstance(runs, Sequence):
+            runs = runs.runs
+        if isinstance(runs, Mapping):
+            runs = runs.values()
+        table = pandas.DataFrame([run.get_globals(group) for run in runs])
+
+    varying = {}
+    for name in table.columns:
+        values = table[name]
+        try:
+            unique_values = list(pandas.unique(values))
+        except TypeError:
+            # Unhashable values such as lists or arrays. Compare them by equality:
+            unique_values = []
+            for value in values:
+                if not any(_values_equal(value, other) for other in unique_values):
+                    unique_values.append(value)
+        if len(unique_values) > 1:
+            varying[name] = unique_values
+    return varying
+
+def _values_equal(a, b):
+    # Whether two values of a global are the same, including arrays and NaNs:
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        try:
+            return np.array_equal(a, b, equal_nan=True)
+        except TypeError:
+            # equal_nan is not supported for non-numeric arrays:
+            return np.array_equal(a, b)
+    try:
+        return bool(a == b) or (a != a and b != b)
+    except ValueError:
+        # e.g. lists containing arrays, whose comparison is ambiguous:
+        return False
+
+def get_image_stack(filepaths, orientation, label, image, max_workers=4, memmap=False):
+    """Read the same saved image from many shots into a single stacked array.
+
+    This is intended for multishot routines that need an image from every shot
+    of a sequence at once, e.g. to average background frames. The shot files
+    are read concurrently, and each image is written directly into the output
+    array as it is read, so that no more than `max_workers` images are held in
+    memory in addition to the stack itself.
+
+    Args:
+        filepaths (:obj:`list` or :obj:`pandas:pandas.DataFrame`): Paths to the
+            shot files to read. If a dataframe is supplied, such as the one
+            returned by :obj:`data`, the paths are taken from its `'filepath'`
+            column.
+        orientation (str): Orientation label of the saved images.
+        label (str): Label of the saved images.
+        image (str): Identifier of the saved images.
+        max_workers (int, optional): The maximum number of shot files read
+            concurrently. Defaults to 4.
+        memmap (bool or str, optional): If `True`, the stack is stored in a
+            memory-mapped temporary `.npy` file rather than in memory, allowing
+            stacks larger than the available RAM. If a string, it is used as the
+            path of the file to create. Either way the file is not deleted
+            automatically: the caller owns it, and its path is available as the
+            `filename` attribute of the returned array. Defaults to `False`.
+
+    Raises:
+        ValueError: If `filepaths` is empty, or if the images do not all have
+            the same shape and dtype.
+
+    Returns:
+        :obj:`numpy:numpy.ndarray`: Array of shape `(len(filepaths),) +
+        image_shape`, in the same order as `filepaths`. The dtype is that of the
+        image in the first shot. If `memmap` is set, a :obj:`numpy:numpy.memmap`
+        is returned instead.
+    """
+    if isinstance(filepaths, pandas.DataFrame):
+        filepaths = filepaths['filepath']
+    filepaths = list(filepaths)
+    if not filepaths:
+        raise ValueError('Cannot stack images; no filepaths given')
+
+    def read_image(filepath):
+        return Run(filepath, no_write=True).get_image(orientation, label, image)
+
+    # The first image determines the shape and dtype of the stack:
+    first_image = read_image(filepaths[0])
+    shape = (len(filepaths),) + first_image.shape
+    dtype = first_image.dtype
+    temporary_file = None
+    if memmap:
+        if memmap is True:
+            with tempfile.NamedTemporaryFile(suffix='.npy', delete=False) as f:
+                memmap = temporary_file = f.name
+        stack = np.lib.format.open_memmap(memmap, mode='w+', dtype=dtype, shape=shape)
+    else:
+        stack = np.empty(shape, dtype=dtype)
+    stack[0] = first_image
+    del first_image
+
+    def read_into_stack(i):
+        data = read_image(filepaths[i])
+        if data.shape != shape[1:]:
+            msg = f"""Cannot stack images; image in {filepaths[i]} has shape
+                {data.shape} but image in {filepaths[0]} has shape {shape[1:]}"""
+            raise ValueError(dedent(msg))
+        if data.dtype != dtype:
+            msg = f"""Cannot stack images; image in {filepaths[i]} has dtype
+                {data.dtype} but image in {filepaths[0]} has dtype {dtype}"""
+            raise ValueError(dedent(msg))
+        stack[i] = data
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Consume the results so that exceptions in the readers are raised here:
+            for _ in executor.map(read_into_stack, range(1, len(filepaths))):
+                pass
+    except Exception:
+        if temporary_file is not None:
+            # The caller never gets the array, so cannot delete the file:
+            del stack
+            Path(temporary_file).unlink()
+        raise
+    if memmap:
+        stack.flush()
+    return stack
+
 def open_file(mode):
     """Decorator for lyse functions to allow using previously opened file with context manager.
     
@@ -283,6 +469,12 @@ class Run(object):
         self.__no_write = no_write
         self.__h5_file = None
         self.__group = None
+        # Caches of the waits table and trace names, which do not change once
+        # the shot has run, so that repeated lookups do not hit the file:
+        self.__waits = None
+        self.__trace_names = None
+        # Globals, by group, likewise cached as they never change:
+        self.__globals = {}
         if not self.no_write:
             self._create_group_if_not_exists(h5_path, '/', 'results')
                      
@@ -490,20 +682,30 @@ class Run(object):
 
         Returns:
             :obj:`numpy:numpy.ndarray`: Returns 2-D timetrace of times `'t'`
-            and values `'values'`.
+            and values `'values'`. If the shared memory cache is enabled (see
+            :mod:`lyse.utils.shot_cache`), the returned arrays are read-only:
+            this includes `'t'` and `'values'` when the trace is already of
+            float dtype, as they are then views of the cached data rather than
+            copies. Use `.copy()` to get arrays that can be modified.
         """
-        if name not in self.h5_file['data']['traces']:
+        if self.__trace_names is None:
+            self.__trace_names = frozenset(self.trace_names())
+        if name not in self.__trace_names:
             raise Exception('The trace \'%s\' does not exist'%name)
         trace = self.h5_file['data']['traces'][name]
+        # Read via the shared-memory cache, if enabled, so that routines running
+        # after the first on this shot do not read the trace from the file again:
+        trace_data = lyse.utils.shot_cache.get_array(self.h5_path, trace.name, lambda: trace[()])
         
         if raw_data:
-            data = trace[()]
+            data = trace_data
         else:
-            data = np.array(trace['t'],dtype=float), np.array(trace['values'],dtype=float)  
+            # Only convert (and hence copy) the fields if they are not already of
+            # float dtype:
+            data = np.asarray(trace_data['t'], dtype=float), np.asarray(trace_data['values'], dtype=float)
         
         return data
 
-    @open_file('r')
     def get_wait(self, name):
         """Returns the wait parameters: label, timeout, duration, and time out status.
 
@@ -511,20 +713,16 @@ class Run(object):
             name (str): Name of the wait to get.
 
         Raises:
-            KeyError if `name` wait does not exist.
+            Exception: If the shot has no waits, or `name` wait does not exist.
 
         Returns:
             tuple: Tuple of the wait parameters.
         """
-        if not 'data' in self.h5_file:
-            raise Exception('The shot has no data group')
-        name=name.encode()
-        if name not in self.h5_file['data']['waits']['label']:
-            raise Exception('The wait \'%s\' does not exist'%name.decode())
-        name_index, = np.where(self.h5_file['data']['waits']['label']==name)[0]
-        return self.h5_file['data']['waits'][name_index]
+        waits, wait_indices = self._get_waits_index()
+        if name not in wait_indices:
+            raise Exception('The wait \'%s\' does not exist'%name)
+        return waits[wait_indices[name]].copy()
 
-    @open_file('r')
     def get_waits(self):
         """Returns the parameters of all waits in the experiment.
 
@@ -534,11 +732,29 @@ class Run(object):
         Returns:
             :obj:`numpy:numpy.ndarray`: Returns 2D structured numpy array of the waits and their parameters.
         """
+        waits, _ = self._get_waits_index()
+        return waits.copy()
+
+    def _get_waits_index(self):
+        """Return the waits table and a dict mapping each wait label to its
+        row in the table, reading them from the file only on first use."""
+        if self.__waits is None:
+            self.__waits = self._read_waits()
+        return self.__waits
+
+    @open_file('r')
+    def _read_waits(self):
         if 'data' not in self.h5_file:
             raise Exception('The shot has no data group')
         if 'waits' not in self.h5_file['data']:
             raise Exception('The shot has no waits')
-        return self.h5_file['data']['waits'][()]
+        waits = self.h5_file['data']['waits'][()]
+        wait_indices = {}
+        for i, label in enumerate(waits['label']):
+            if isinstance(label, bytes):
+                label = label.decode()
+            wait_indices.setdefault(label, i)
+        return waits, wait_indices
 
     @open_file('r')        
     def get_result_array(self, group, name):
@@ -873,7 +1089,8 @@ class Run(object):
             Exception: If the image or paths do not exist.
 
         Returns:
-            :obj:`numpy:numpy.ndarray`: 2-D image array.
+            :obj:`numpy:numpy.ndarray`: 2-D image array. Read-only if the shared
+            memory cache is enabled (see :mod:`lyse.utils.shot_cache`).
         """
         if 'images' not in self.h5_file:
             raise Exception('File does not contain any images')
@@ -883,7 +1100,8 @@ class Run(object):
             raise Exception('File does not contain any images with label \'%s\''%label)
         if image not in self.h5_file['images'][orientation][label]:
             raise Exception('Image \'%s\' not found in file'%image)
-        return np.array(self.h5_file['images'][orientation][label][image])
+        dataset = self.h5_file['images'][orientation][label][image]
+        return lyse.utils.shot_cache.get_array(self.h5_path, dataset.name, lambda: np.array(dataset))
 
     @open_file('r')    
     def get_images(self, orientation, label, *images):
@@ -954,10 +1172,12 @@ class Run(object):
             raise Exception('File does not contain any images with orientation \'%s\''%orientation)
         return get_attributes(self.h5_file['images'][orientation])
 
-    @open_file('r')
     def get_globals(self, group=None):
         """Get globals from the shot.
 
+        The globals are read from the file on the first call for each `group`
+        and cached thereafter.
+
         Args:
             group (str, optional): If `None`, return all global variables.
                 If defined, only return globals from `group`.
@@ -965,6 +1185,13 @@ class Run(object):
         Returns:
             dict: Dictionary of globals and their values.
         """
+        group = group or None
+        if group not in self.__globals:
+            self.__globals[group] = self._read_globals(group)
+        return dict(self.__globals[group])
+
+    @open_file('r')
+    def _read_globals(self, group):
         if not group:
             return dict(self.h5_file['globals'].attrs)
         else:
@@ -1109,6 +1336,43 @@ class Run(object):
         """
         return globals_diff(self, other_run, group)            
     
+
+class _LazyRuns(Mapping):
+    """Read-only mapping of shot filepaths to read-only :obj:`Run` objects.
+
+    The filepaths are stored in a single numpy array, and each `Run` is only
+    created the first time it is accessed, so that constructing a
+    :obj:`Sequence` for many shots does not create many objects up front.
+    """
+    def __init__(self, run_paths):
+        self._paths = np.array(list(run_paths), dtype=object)
+        self._path_set = None
+        self._runs = {}
+
+    def _get_path_set(self):
+        if self._path_set is None:
+            self._path_set = frozenset(self._paths)
+        return self._path_set
+
+    def __getitem__(self, path):
+        try:
+            return self._runs[path]
+        except KeyError:
+            if path not in self._get_path_set():
+                raise
+        run = self._runs[path] = Run(path, no_write=True)
+        return run
+
+    def __contains__(self, path):
+        return path in self._get_path_set()
+
+    def __iter__(self):
+        # Drop duplicates whilst preserving order, as a dict would:
+        return iter(dict.fromkeys(self._paths))
+
+    def __len__(self):
+        return len(self._get_path_set())
+
         
 class Sequence(Run):
     def __init__(self, h5_path, run_paths, no_write=False):
@@ -1146,8 +1410,9 @@ class Sequence(Run):
         super().__init__(h5_path, no_write=no_write)
 
         if isinstance(run_paths, pandas.DataFrame):
-            run_paths = run_paths['filepath']      
-        self.runs = {path: Run(path,no_write=True) for path in run_paths}
+            run_paths = run_paths['filepath']
+        # Runs are created on first access:
+        self.runs = _LazyRuns(run_paths)
 
     def get_trace(self,*args):
         """Get the named trace from each run in the sequence.
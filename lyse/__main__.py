@@ -67,6 +67,7 @@ import lyse.utils.gui
 import lyse.routines
 import lyse.filebox
 import lyse.communication
+from lyse.dataframe_utilities import infer_column
 
 class LyseMainWindow(QtWidgets.QMainWindow):
     # A signal to show that the window is shown and painted.
@@ -151,6 +152,12 @@ class Lyse(object):
         from_multishot = queue.Queue()
 
         self.output_box = OutputBox(self.ui.verticalLayout_output_box)
+        # Idle analysis subprocesses to hand out to routines as they are added:
+        try:
+            worker_pool_size = self.exp_config.getint('lyse', 'worker_pool_size')
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            worker_pool_size = 1
+        self.worker_pool = lyse.routines.WorkerPool(self, self.output_box.port, worker_pool_size)
         self.singleshot_routinebox = lyse.routines.RoutineBox(self, self.ui.verticalLayout_singleshot_routinebox, self.exp_config,
                                                 self, to_singleshot, from_singleshot, self.output_box.port)
         self.multishot_routinebox = lyse.routines.RoutineBox(self, self.ui.verticalLayout_multishot_routinebox, self.exp_config,
@@ -215,12 +222,14 @@ class Lyse(object):
     def terminate_all_workers(self):
         for routine in self.singleshot_routinebox.routines + self.multishot_routinebox.routines:
             routine.end_child()
+        self.worker_pool.terminate()
 
     def workers_terminated(self):
         terminated = {}
         for routine in self.singleshot_routinebox.routines + self.multishot_routinebox.routines:
             routine.worker.poll()
             terminated[routine.filepath] = routine.worker.returncode is not None
+        terminated.update(self.worker_pool.workers_terminated())
         return terminated
 
     def are_you_sure(self):
@@ -438,7 +447,7 @@ class Lyse(object):
         QtWidgets.QShortcut('Shift+Del', self.ui, lambda: self.delete_items(False))
 
     def on_save_dataframe_triggered(self, choose_folder=True):
-        df = self.filebox.shots_model.dataframe.copy()
+        df = self.filebox.shots_model.dataframe_with_spilled()
         if len(df) > 0:
             default = self.exp_config.get('paths', 'experiment_shot_storage')
             if choose_folder:
@@ -455,10 +464,9 @@ class Lyse(object):
                 filename = "dataframe_{}_{}.pkl".format(sequence.to_pydatetime().strftime("%Y%m%dT%H%M%S"),labscript[:-3])
                 if not choose_folder:
                     save_path = os.path.dirname(sequence_df['filepath'].iloc[0])
-                sequence_df.infer_objects()
-                for col in sequence_df.columns :
-                    if sequence_df[col].dtype == object:
-                        sequence_df[col] = pandas.to_numeric(sequence_df[col], errors='ignore')
+                # Columns may only be object because of values in other sequences:
+                for col in sequence_df.columns[sequence_df.dtypes == object]:
+                    sequence_df[col] = infer_column(sequence_df[col])
                 sequence_df.to_pickle(os.path.join(save_path, filename))
         else:
             lyse.utils.gui.error_dialog(self.app, 'Dataframe is empty')
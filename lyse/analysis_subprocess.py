@@ -14,7 +14,6 @@
 """
  
 import labscript_utils.excepthook # I do magic stuff, so import must be in place
-import labscript_utils.h5_lock, h5py
 
 from labscript_utils.ls_zprocess import ProcessTree
 
@@ -32,34 +31,14 @@ from qtutils.qt.QtCore import QSettings, QByteArray
 from qtutils import inmain, inmain_decorator, UiLoader
 import qtutils.icons
 
-import multiprocessing
-
-from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
-
 # Labscript imports
 from labscript_utils.modulewatcher import ModuleWatcher
 from labscript_utils import dedent
 
-
-# Associate app windows with OS menu shortcuts:
-import desktop_app
-desktop_app.set_process_appid('lyse')
-
-# lyse imports
-import lyse.utils
-import lyse.utils.worker
-import lyse.figure_manager
-
-# This process is not fork-safe. Spawn fresh processes on platforms that would fork:
-if (
-    hasattr(multiprocessing, 'get_start_method')
-    and multiprocessing.get_start_method(True) != 'spawn'
-):
-    multiprocessing.set_start_method('spawn')
-
-# read labconfig once for plot window locations
-autoload_config_file = lyse.utils.LABCONFIG.get('lyse', 'autoload_config_file')
-config_dir = os.path.dirname(autoload_config_file)
+# Everything else (h5py, lyse, and with it numpy and pandas, matplotlib and so
+# on) is imported in the __main__ block below after connecting to the parent, so
+# that the parent does not wait on these imports when starting a worker. Use
+# python -X importtime to see what is imported before the connection is made.
 
 class PlotWindowCloseEvent(QtGui.QCloseEvent):
     def __init__(self, force, *args, **kwargs):
@@ -128,6 +107,9 @@ class Plot(object):
         # figure.tight_layout()
         self.figure = figure
         self.canvas = figure.canvas
+        # Imported here as it loads the matplotlib Qt backend, which is not needed
+        # until there is a figure to show:
+        from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
         self.navigation_toolbar = NavigationToolbar(self.canvas, self.ui)
 
         self.lock_action = self.navigation_toolbar.addAction(
@@ -325,8 +307,8 @@ class AnalysisWorker(object):
                     self.close_plots()
                     inmain(qapplication.quit)
                 elif task == 'analyse':
-                    path = data
-                    success = self.do_analysis(path)
+                    path, shot_data = data
+                    success = self.do_analysis(path, shot_data)
                     if success:
                         if lyse.utils.worker._delay_flag:
                             lyse.utils.worker.delay_event.wait()
@@ -344,7 +326,7 @@ class AnalysisWorker(object):
             QtCore.QCoreApplication.instance().postEvent(plot.ui, event)
         
     @inmain_decorator()
-    def do_analysis(self, path):
+    def do_analysis(self, path, shot_data=None):
         now = time.strftime('[%x %X]')
         if path is not None:
             print('%s %s %s ' %(now, os.path.basename(self.filepath), os.path.basename(path)))
@@ -357,11 +339,17 @@ class AnalysisWorker(object):
         self.routine_module.__dict__.clear()
         self.routine_module.__dict__.update(self.routine_module_clean_dict)
 
+        if path != lyse.utils.worker.path:
+            # Free shared memory holding data from the previous shot, which all
+            # other routines have finished with by now:
+            lyse.utils.shot_cache.release()
+
         # global variables used to communicate between analysis processes and GUI functions
         lyse.utils.worker.path = path
         lyse.utils.worker.plots = self.plots
         lyse.utils.worker.Plot = Plot
         lyse.utils.worker._updated_data = {}
+        lyse.utils.worker._shot_data = shot_data
         lyse.utils.worker._delay_flag = False
         lyse.utils.worker.delay_event.clear()
 
@@ -394,12 +382,17 @@ class AnalysisWorker(object):
             self.post_analysis_plot_actions()
         
     def pre_analysis_plot_actions(self):
+        if lyse.figure_manager.figuremanager is None:
+            # pyplot has not been imported, so there are no figures:
+            return
         lyse.figure_manager.figuremanager.reset()
         for plot in self.plots.values():
             plot.save_axis_limits()
             plot.clear()
 
     def post_analysis_plot_actions(self):
+        if lyse.figure_manager.figuremanager is None:
+            return
         # reset the current figure to figure 1:
         lyse.figure_manager.figuremanager.set_first_figure_current()
         # Introspect the figures that were produced:
@@ -488,23 +481,80 @@ class AnalysisWorker(object):
 
     def reset_figs(self):
         pass
-        
-        
-if __name__ == '__main__':
 
-    os.environ['MPLBACKEND'] = "qt5agg"
 
-    lyse.utils.worker.spinning_top = True
+def report_startup_failure(to_parent, from_parent, message):
+    """Run in place of an AnalysisWorker if this process failed to start after
+    connecting to the parent, which is no longer waiting on the startup and would
+    otherwise wait forever for a response. Reply to every request to analyse a
+    shot with an error, printing the reason each time so that it is shown in the
+    output box, until told to quit."""
+    while True:
+        request = from_parent.get()
+        if not isinstance(request, (list, tuple)):
+            # The filepath of the routine to run:
+            continue
+        task, data = request
+        if task == 'quit':
+            break
+        sys.stderr.write(message)
+        to_parent.put(['error', {}])
 
-    lyse.figure_manager.install()
 
-    # Where are pylab features used?  Should this be here?
-    import pylab
+if __name__ == '__main__':
 
+    os.environ['MPLBACKEND'] = "qt5agg"
+
+    # Connect to the parent first: once connected, the parent can carry on whilst we
+    # import everything else, and only has to wait for that if it needs us to run a
+    # routine before we are done.
     process_tree = ProcessTree.connect_to_parent()
     to_parent = process_tree.to_parent
     from_parent = process_tree.from_parent
     kill_lock = process_tree.kill_lock
+
+    try:
+        import labscript_utils.h5_lock, h5py
+
+        # Associate app windows with OS menu shortcuts:
+        import desktop_app
+        desktop_app.set_process_appid('lyse')
+
+        # This process is not fork-safe. Spawn fresh processes on platforms that would fork:
+        import multiprocessing
+        if (
+            hasattr(multiprocessing, 'get_start_method')
+            and multiprocessing.get_start_method(True) != 'spawn'
+        ):
+            multiprocessing.set_start_method('spawn')
+
+        # lyse imports
+        import lyse.utils
+        import lyse.utils.worker
+        import lyse.utils.shot_cache
+        import lyse.figure_manager
+
+        # read labconfig once for plot window locations
+        autoload_config_file = lyse.utils.LABCONFIG.get('lyse', 'autoload_config_file')
+        config_dir = os.path.dirname(autoload_config_file)
+
+        lyse.utils.worker.spinning_top = True
+
+        # Must be installed before the user's routine imports pyplot. Lazily, so
+        # that pyplot and the matplotlib Qt backend are only imported by
+        # routines that use them:
+        lyse.figure_manager.install(lazy=True)
+    except Exception:
+        # The parent is not waiting for us to finish starting up, so report the
+        # error in response to its requests rather than exiting:
+        traceback_lines = traceback.format_exception(*sys.exc_info())
+        message = 'Analysis worker failed to start:\n' + ''.join(traceback_lines)
+        sys.stderr.write(message)
+        report_startup_failure(to_parent, from_parent, message)
+        sys.exit(1)
+
+    # Wait to be told which routine to run. Idle workers from the pool wait here
+    # with all of the above already imported:
     filepath = from_parent.get()
 
     # Rename this module to _analysis_subprocess and put it in sys.modules
@@ -69,18 +69,14 @@ class WebServer(ZMQServer):
 
     @inmain_decorator(wait_for_return=True)
     def _copy_dataframe(self):
-        df = self.app.filebox.shots_model.dataframe.copy(deep=True)
-        return df
+        # Includes any columns spilled to disk to save memory:
+        return self.app.filebox.shots_model.dataframe_with_spilled()
 
     def _retrieve_dataframe(self):
-        # infer_objects() picks fixed datatypes for columns that are compatible with
-        # fixed datatypes, dramatically speeding up pickling. It is called here
-        # rather than when updating the dataframe as calling it during updating may
-        # call it needlessly often, whereas it only needs to be called prior to
-        # sending the dataframe to a client requesting it, as we're doing now.
-        df = self._copy_dataframe()
-        df.infer_objects()
-        return df
+        # Columns of the dataframe are kept with fixed datatypes where possible as
+        # shots are added and updated (see DataFrameModel.update_row), so there is
+        # no need to infer them again here before pickling.
+        return self._copy_dataframe()
 
     def _extract_n_sequences_from_df(self, df, n_sequences):
         # If the dataframe is empty, just return it, otherwise accessing columns
@@ -13,7 +13,11 @@
 """Lyse dataframe utilities
 """
 
+import functools
+import numbers
+
 import labscript_utils.h5_lock, h5py
+import numpy as np
 import pandas
 import tzlocal
 
@@ -27,6 +31,11 @@ from labscript_utils.labconfig import LabConfig
 # lyse imports
 from lyse.utils import LABCONFIG
 
+SHOT_ATTRIBUTE_COLUMNS = ('filepath', 'agnostic_path', 'sequence', 'sequence_index',
+                          'labscript', 'run time', 'run number', 'run repeat', 'n_runs')
+"""Top-level columns of the lyse dataframe that are read from a shot's
+attributes rather than being globals, results or image attributes"""
+
 def rangeindex_to_multiindex(df, inplace):
     if isinstance(df.index, pandas.MultiIndex):
         # The dataframe has already been converted.
@@ -53,13 +62,93 @@ def rangeindex_to_multiindex(df, inplace):
     df.sort_index(inplace=True)
     return df
 
+def get_globals_columns(df):
+    """Return the columns of the lyse dataframe `df` that contain globals.
+
+    These are the columns whose labels have only a single nonempty level, other
+    than those in SHOT_ATTRIBUTE_COLUMNS."""
+    columns = []
+    for column in df.columns:
+        levels = column if isinstance(column, tuple) else (column,)
+        if levels[0] in SHOT_ATTRIBUTE_COLUMNS or any(levels[1:]):
+            continue
+        columns.append(column)
+    return columns
+
+@functools.lru_cache(maxsize=None)
+def get_localzone():
+    """The local timezone, looked up once per process rather than per shot"""
+    return tzlocal.get_localzone()
+
 def asdatetime(timestr):
     if isinstance(timestr, bytes):
         timestr = timestr.decode('utf-8')
-    tz = tzlocal.get_localzone()
-    return pandas.Timestamp(timestr, tz=tz)
+    return pandas.Timestamp(timestr, tz=get_localzone())
+
+@functools.lru_cache(maxsize=1024)
+def _sequence_asdatetime(timestr):
+    # Many shots share the same sequence, so cache the parsed timestamps
+    # (which are immutable) rather than parsing the same string repeatedly:
+    return asdatetime(timestr)
 
-def get_nested_dict_from_shot(filepath):
+def asdatetimes(timestrs):
+    """Vectorised version of asdatetime(). Parses a sequence of time strings
+    (or bytes) and returns a DatetimeIndex localised to the local timezone.
+    Missing values (NaN) become NaT."""
+    timestrs = [t.decode('utf-8') if isinstance(t, bytes) else t for t in timestrs]
+    try:
+        # Accepts a mix of ISO 8601 variants, such as with and without separators:
+        times = pandas.to_datetime(timestrs, format='ISO8601')
+    except (ValueError, TypeError):
+        # Other formats, or pandas < 2 which does not support format='ISO8601'.
+        # Parse each string on its own as asdatetime() does:
+        return pandas.DatetimeIndex([pandas.NaT if pandas.isna(t) else asdatetime(t) for t in timestrs])
+    return pandas.DatetimeIndex(times).tz_localize(get_localzone())
+
+def parse_run_times(df):
+    """Parse the 'run time' column of a dataframe of shots read with
+    parse_run_time=False all at once with asdatetimes(), in place."""
+    column_name = ('run time',) + ('',) * (df.columns.nlevels - 1)
+    if column_name in df.columns:
+        df[column_name] = asdatetimes(df[column_name])
+
+def _get_shot_attributes(filepath, h5_file, parse_run_time=True):
+    """Return a dict of the top-level, non-hierarchical data for a shot: its
+    paths, the sequence and run it belongs to, and its labscript file. If
+    parse_run_time is False, the run time is left as a string, for parsing
+    together with those of other shots by parse_run_times()."""
+    attributes = {}
+    attributes['filepath'] = _ensure_str(filepath)
+    attributes['agnostic_path'] = labscript_utils.shared_drive.path_to_agnostic(filepath)
+    seq_id = _ensure_str(h5_file.attrs['sequence_id'])
+    attributes['sequence'] = _sequence_asdatetime(seq_id.split('_')[0])
+    try:
+        attributes['sequence_index'] = h5_file.attrs['sequence_index']
+    except KeyError:
+        attributes['sequence_index'] = None
+    if 'script' in h5_file: 
+        attributes['labscript'] = _ensure_str(h5_file['script'].attrs['name'])
+    try:
+        attributes['run time'] = _ensure_str(h5_file.attrs['run time'])
+        if parse_run_time:
+            attributes['run time'] = asdatetime(attributes['run time'])
+    except KeyError:
+        attributes['run time'] = float('nan')
+    try:    
+        attributes['run number'] = h5_file.attrs['run number']
+    except KeyError:
+        attributes['run number'] = float('nan')
+    try:
+        attributes['run repeat'] = h5_file.attrs['run repeat']
+    except KeyError:
+        attributes['run repeat'] = 0
+    try:
+        attributes['n_runs'] = h5_file.attrs['n_runs']
+    except KeyError:
+        attributes['n_runs'] = float('nan')
+    return attributes
+
+def get_nested_dict_from_shot(filepath, parse_run_time=True):
     row = get_shot_globals(filepath)
     with h5py.File(filepath,'r') as h5_file:
         if 'results' in h5_file:
@@ -78,34 +167,14 @@ def get_nested_dict_from_shot(filepath):
                             for key, val in get_attributes(group[image]).items():
                                 if not isinstance(val, h5py.Reference):
                                     row[orientation][label][image][key] = val
-        row['filepath'] = _ensure_str(filepath)
-        row['agnostic_path'] = labscript_utils.shared_drive.path_to_agnostic(filepath)
-        seq_id = _ensure_str(h5_file.attrs['sequence_id'])
-        row['sequence'] = asdatetime(seq_id.split('_')[0])
-        try:
-            row['sequence_index'] = h5_file.attrs['sequence_index']
-        except KeyError:
-            row['sequence_index'] = None
-        if 'script' in h5_file: 
-            row['labscript'] = _ensure_str(h5_file['script'].attrs['name'])
-        try:
-            row['run time'] = asdatetime(_ensure_str(h5_file.attrs['run time']))
-        except KeyError:
-            row['run time'] = float('nan')
-        try:    
-            row['run number'] = h5_file.attrs['run number']
-        except KeyError:
-            row['run number'] = float('nan')
-        try:
-            row['run repeat'] = h5_file.attrs['run repeat']
-        except KeyError:
-            row['run repeat'] = 0
-        try:
-            row['n_runs'] = h5_file.attrs['n_runs']
-        except KeyError:
-            row['n_runs'] = float('nan')
+        row.update(_get_shot_attributes(filepath, h5_file, parse_run_time))
         return row
-            
+
+def get_flat_dict_from_shot(filepath, parse_run_time=True):
+    """Return the data for a shot as a flat dictionary with tuple keys. See
+    _get_shot_attributes() for parse_run_time."""
+    return flatten_dict(get_nested_dict_from_shot(filepath, parse_run_time))
+
 def flatten_dict(dictionary, keys=tuple()):
     """Takes a nested dictionary whose keys are strings, and returns a
     flat dictionary whose keys are tuples of strings, each element of
@@ -119,9 +188,12 @@ def flatten_dict(dictionary, keys=tuple()):
             result[keys + (name,)] = dictionary[name]
     return result
             
-def flat_dict_to_hierarchical_dataframe(dictionary):
-    """Make all the keys tuples of the same length"""
-    max_tuple_length = 2 # Must have at least two levels to make a MultiIndex
+def flat_dict_to_hierarchical_dataframe(dictionary, nlevels=2):
+    """Make all the keys tuples of the same length, and at least nlevels long.
+    Passing the nlevels of the dataframe the result is to be concatenated with
+    means it won't need padding later."""
+    # Must have at least two levels to make a MultiIndex
+    max_tuple_length = max(nlevels, 2)
     for key in dictionary:
         max_tuple_length = max(max_tuple_length,len(key))
     result = {}
@@ -133,58 +205,226 @@ def flat_dict_to_hierarchical_dataframe(dictionary):
     index = pandas.MultiIndex.from_tuples(sorted(result.keys()))
     return pandas.DataFrame([result],columns=index)  
 
+@functools.lru_cache(maxsize=32)
+def _flat_series_layout(keys):
+    # The order in which to take the values of a flat dict with the given keys, and
+    # the index for the resulting series. Shots from the same sequence (and often
+    # from different ones) have the same keys, so this is cached rather than sorting
+    # and building a new index every time:
+    labels = [key if len(key) > 1 else key[0] for key in keys]
+    order = sorted(range(len(labels)), key=lambda i:
+        (len(labels[i]),) + labels[i] if isinstance(labels[i], tuple) else (1, labels[i]))
+    return order, pandas.Index([labels[i] for i in order])
+
 def flat_dict_to_flat_series(dictionary):
-    result = {}
-    for key in dictionary:
-        if len(key) > 1:
-            result[key] = dictionary[key]
-        else:
-            result[key[0]] = dictionary[key]
-    keys = list(result.keys())
-    keys.sort(key = lambda item: 
-        (len(item),) + item if isinstance(item, tuple) else (1,item))
-    return pandas.Series(result,index=keys)  
+    order, index = _flat_series_layout(tuple(dictionary))
+    values = list(dictionary.values())
+    return pandas.Series([values[i] for i in order], index=index)
           
-def get_dataframe_from_shot(filepath):
-    nested_dict = get_nested_dict_from_shot(filepath)
-    flat_dict =  flatten_dict(nested_dict)
-    df = flat_dict_to_hierarchical_dataframe(flat_dict)
+def get_dataframe_from_shot(filepath, nlevels=2, parse_run_time=True):
+    flat_dict = get_flat_dict_from_shot(filepath, parse_run_time)
+    df = flat_dict_to_hierarchical_dataframe(flat_dict, nlevels)
     return df
     
 def get_dataframe_from_shots(filepaths):
-    return concat_with_padding(*[get_dataframe_from_shot(filepath) for filepath in filepaths])
+    # Parse the run times of all shots at once:
+    df = concat_with_padding(*[get_dataframe_from_shot(filepath, parse_run_time=False)
+                               for filepath in filepaths])
+    parse_run_times(df)
+    return df
 
 def get_series_from_shot(filepath):
-    nested_dict = get_nested_dict_from_shot(filepath)
-    flat_dict =  flatten_dict(nested_dict)
+    flat_dict = get_flat_dict_from_shot(filepath)
     s = flat_dict_to_flat_series(flat_dict)
     return s
     
 def pad_columns(df, n):
-    """Add depth to hiererchical column labels with empty strings"""
+    """Add depth to hiererchical column labels with empty strings.
+
+    Only the column labels are replaced, by appending levels containing only
+    the empty string to the MultiIndex. The data is not copied; the returned
+    dataframe shares it with df."""
     if df.columns.nlevels == n:
         return df
-    new_columns = []
-    data = {}
-    for column in df.columns:
-        new_column = column + ('',)*(n-len(column))
-        new_columns.append(new_column)
-        data[new_column] = df[column]
-    index = pandas.MultiIndex.from_tuples(new_columns)
-    return pandas.DataFrame(data,columns = index)
+    extra_levels = n - df.columns.nlevels
+    padding_codes = np.zeros(len(df.columns), dtype=int)
+    new_columns = pandas.MultiIndex(
+        levels=list(df.columns.levels) + [['']] * extra_levels,
+        codes=list(df.columns.codes) + [padding_codes] * extra_levels,
+    )
+    df = df.copy(deep=False)
+    df.columns = new_columns
+    return df
 
 def concat_with_padding(*dataframes):
     """Concatenates dataframes with MultiIndex column labels,
     padding shallower hierarchies such that the MultiIndexes have
-    the same nlevels."""
+    the same nlevels. Columns that only have dtype object in the result
+    because of a mix of dtypes in the inputs are converted with
+    infer_column()."""
     dataframes = list(dataframes)
     max_nlevels = max(df.columns.nlevels for df in dataframes)
     # Remove empty dataframes (these don't concat since pandas 0.18) 
     dataframes = [df for df in dataframes if not df.empty]
+    typed_columns = set()
+    categorical_columns = set()
     for i, df in enumerate(dataframes):
         if df.columns.nlevels < max_nlevels:
-            dataframes[i] = pad_columns(df, max_nlevels)
-    return pandas.concat(dataframes, ignore_index=True)
+            dataframes[i] = df = pad_columns(df, max_nlevels)
+        dtypes = df.dtypes
+        typed_columns.update(dtypes.index[dtypes != object])
+        categorical_columns.update(
+            column for column, dtype in dtypes.items() if isinstance(dtype, pandas.CategoricalDtype)
+        )
+    categorical_dtypes = {}
+    for column in categorical_columns:
+        dtype = _union_categorical_dtype(dataframes, column)
+        if dtype is None:
+            continue
+        categorical_dtypes[column] = dtype
+        for i, df in enumerate(dataframes):
+            if column in df.columns and df[column].dtype != dtype:
+                dataframes[i] = df = df.copy(deep=False)
+                df[column] = df[column].astype(dtype)
+    result = pandas.concat(dataframes, ignore_index=True)
+    for column, dtype in categorical_dtypes.items():
+        # Inputs that lacked the column may still have made it lose its dtype:
+        if result[column].dtype != dtype:
+            result[column] = result[column].astype(dtype)
+    dtypes = result.dtypes
+    for column in dtypes.index[dtypes == object]:
+        if column in typed_columns:
+            result[column] = infer_column(result[column])
+    return result
+
+def _union_categorical_dtype(dataframes, column):
+    # Return a CategoricalDtype whose categories are those of all categorical
+    # inputs for the given column, plus any strings in non-categorical inputs, or
+    # None if any non-categorical input has values other than strings.
+    categories = []
+    for df in dataframes:
+        if column not in df.columns:
+            continue
+        series = df[column]
+        if isinstance(series.dtype, pandas.CategoricalDtype):
+            categories.append(series.cat.categories)
+        elif pandas.api.types.infer_dtype(series, skipna=True) in ('string', 'empty'):
+            categories.append(pandas.Index(series.dropna().unique()))
+        else:
+            return None
+    # Existing categories first, so that codes of the larger inputs are unchanged:
+    union = categories[0].append(categories[1:]).unique()
+    return pandas.CategoricalDtype(union)
+
+CATEGORICAL_MAX_FRACTION = 0.5
+"""Columns of strings with at most this many distinct values per row are stored
+as pandas categoricals by categorize_columns()"""
+
+def categorize_columns(df, max_fraction=CATEGORICAL_MAX_FRACTION):
+    """Convert columns of strings that repeat the same few values, such as the
+    labscript file or string globals, to pandas categoricals. These use much less
+    memory than columns of Python strings and are faster to pickle, compare and
+    group by.
+
+    Args:
+        df (:obj:`pandas:pandas.DataFrame`): The dataframe, which is modified in
+            place.
+        max_fraction (float, optional): Only columns whose number of distinct
+            values is at most this fraction of the number of rows are converted.
+
+    Returns:
+        :obj:`pandas:pandas.DataFrame`: The same dataframe, for convenience.
+    """
+    for column, dtype in df.dtypes.items():
+        # Strings are stored with dtype object, or with the string dtype in
+        # pandas >= 3:
+        if isinstance(dtype, pandas.CategoricalDtype) or not (
+            pandas.api.types.is_object_dtype(dtype) or pandas.api.types.is_string_dtype(dtype)
+        ):
+            continue
+        series = df[column]
+        if pandas.api.types.infer_dtype(series, skipna=True) != 'string':
+            continue
+        if series.nunique() <= max_fraction * len(series):
+            df[column] = series.astype('category')
+    return df
+
+def _is_missing(value):
+    return value is None or (isinstance(value, (float, np.floating)) and np.isnan(value))
+
+def infer_column(series):
+    """Convert a column of dtype object to the most specific dtype that can hold
+    its values. These are lyse's rules for column dtypes, where None and NaN
+    are considered missing values:
+
+    - bools: bool if there are no missing values, otherwise object
+    - integers: int64 if there are no missing values, otherwise float64
+    - integers and floats: float64
+    - datetimes: datetime64, with NaT for missing values
+    - anything else: object
+
+    Columns of strings may additionally be stored as categoricals, see
+    categorize_columns()."""
+    kind = pandas.api.types.infer_dtype(series, skipna=True)
+    if kind == 'boolean':
+        if series.isna().any():
+            return series
+        return series.astype(bool)
+    if kind == 'integer':
+        if series.isna().any():
+            return series.astype(float)
+        return series.astype(np.int64)
+    if kind in ('floating', 'mixed-integer-float'):
+        return series.astype(float)
+    if kind == 'datetime':
+        try:
+            return pandas.to_datetime(series)
+        except (ValueError, TypeError):
+            # e.g. datetimes in more than one timezone
+            return series
+    return series
+
+def promoted_dtype(dtype, value):
+    """Return the dtype a column of dtype `dtype` needs to be converted to in
+    order to hold `value`, according to the rules of infer_column(). If dtype
+    is None, returns the dtype of a new column that will hold value in one row
+    and have missing values in all others."""
+    if isinstance(value, (bool, np.bool_)):
+        kind = 'b'
+    elif isinstance(value, numbers.Integral):
+        kind = 'i'
+    elif isinstance(value, numbers.Real):
+        kind = 'f'
+    else:
+        kind = 'O'
+    if dtype is None:
+        if kind in 'if':
+            return np.dtype(float)
+        return np.dtype(object)
+    if isinstance(dtype, pandas.CategoricalDtype):
+        if _is_missing(value) or (isinstance(value, str) and value in dtype.categories):
+            return dtype
+        if isinstance(value, str):
+            return pandas.CategoricalDtype(dtype.categories.append(pandas.Index([value])))
+        return np.dtype(object)
+    if isinstance(dtype, pandas.StringDtype):
+        # Columns of strings in pandas >= 3:
+        if _is_missing(value) or isinstance(value, str):
+            return dtype
+        return np.dtype(object)
+    if _is_missing(value):
+        if dtype.kind in 'iu':
+            return np.dtype(float)
+        if dtype.kind == 'b':
+            return np.dtype(object)
+        return dtype
+    if kind == 'b' and dtype.kind == 'b':
+        return dtype
+    if kind == 'i' and dtype.kind in 'iuf':
+        return dtype
+    if kind == 'f' and dtype.kind in 'iuf':
+        return np.dtype(float)
+    return np.dtype(object)
     
 def replace_with_padding(df, row, index):
     if df.columns.nlevels < row.columns.nlevels:
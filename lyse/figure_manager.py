@@ -15,6 +15,8 @@
 
 from collections import OrderedDict
 import sys
+import importlib.abc
+import importlib.util
 
 from labscript_utils import dedent
 
@@ -132,12 +134,55 @@ class FigureManager(object):
 figuremanager = None
 matplotlib = None
 
-def install():
+class _PyplotImportHook(importlib.abc.MetaPathFinder):
+    """Import hook that installs the figure manager as soon as matplotlib.pyplot
+    has been imported, before the importer gets hold of the module"""
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname != 'matplotlib.pyplot':
+            return None
+        # Only needed once. Find the real spec with the remaining finders:
+        sys.meta_path.remove(self)
+        spec = importlib.util.find_spec(fullname)
+        if spec is not None and spec.loader is not None:
+            spec.loader = _PyplotLoader(spec.loader)
+        return spec
+
+class _PyplotLoader(importlib.abc.Loader):
+    """Wraps the loader of matplotlib.pyplot to install the figure manager once
+    the module has been executed"""
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.loader.exec_module(module)
+        # The import system only binds the submodule to its parent package once
+        # this returns, but the figure manager accesses it as matplotlib.pyplot:
+        sys.modules['matplotlib'].pyplot = module
+        _install()
+
+def install(lazy=False):
+    """Replace pyplot's figure(), close() and show() with those of the figure
+    manager. If lazy is True, this is deferred until matplotlib.pyplot is first
+    imported, so that processes that never plot do not pay for importing it.
+    Either way, install() must be called before pyplot is imported."""
     if 'matplotlib.pyplot' in sys.modules:
         message = ('install() must be imported prior to importing pylab/pyplot ' +
                    'in order to correctly override the figure() function.')
         raise RuntimeError(message)
+    if lazy:
+        sys.meta_path.insert(0, _PyplotImportHook())
+    else:
+        _install()
 
+def _install():
     global matplotlib
     global figuremanager
     import matplotlib.pyplot
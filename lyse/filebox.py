@@ -21,6 +21,8 @@ import subprocess
 import time
 import traceback
 import queue
+import collections
+import tempfile
 
 # 3rd party imports:
 import numpy as np
@@ -36,12 +38,14 @@ from labscript_utils.qtwidgets.headerview_with_widgets import HorizontalHeaderVi
 # qt imports
 from qtutils.qt import QtCore, QtGui, QtWidgets
 from qtutils.qt.QtCore import pyqtSignal as Signal
-from qtutils import inmain_decorator, UiLoader, DisconnectContextManager
+from qtutils import inmain_decorator, inmain_later, UiLoader, DisconnectContextManager
 from qtutils.auto_scroll_to_end import set_auto_scroll_to_end
 import qtutils.icons
 
 # Lyse imports
-from lyse.dataframe_utilities import concat_with_padding, get_dataframe_from_shot, replace_with_padding
+from lyse.dataframe_utilities import (concat_with_padding, get_dataframe_from_shot,
+                                      parse_run_times, replace_with_padding, promoted_dtype, categorize_columns,
+                                      get_globals_columns, SHOT_ATTRIBUTE_COLUMNS)
 import lyse.utils
 import lyse.utils.gui
 import lyse.widgets
@@ -257,15 +261,24 @@ class DataFrameModel(QtCore.QObject):
     
     columns_changed = Signal()
 
+    # Minimum time between applying queued row updates to the model, see
+    # queue_row_update():
+    UPDATE_INTERVAL_MS = 100
+
     def __init__(self, app, view, exp_config):
         QtCore.QObject.__init__(self)
         self.app = app
         self._view = view
         self.exp_config = exp_config
-        self._model = lyse.widgets.UneditableModel()
+        self._model = lyse.widgets.DataFrameItemModel(self.vertical_header_text)
         self.row_number_by_filepath = {}
         self._previous_n_digits = 0
 
+        # Row updates queued from other threads but not yet applied, by filepath:
+        self._pending_updates = {}
+        self._pending_updates_lock = threading.Lock()
+        self._flush_scheduled = False
+
         self._header = HorizontalHeaderViewWithWidgets(self._model)
         self._vertheader = QtWidgets.QHeaderView(QtCore.Qt.Vertical)
         self._vertheader.setSectionResizeMode(QtWidgets.QHeaderView.Fixed)
@@ -284,6 +297,7 @@ class DataFrameModel(QtCore.QObject):
         self._view.setVerticalHeader(self._vertheader)
         self._delegate = lyse.widgets.ItemDelegate(self.app, self._view, self._model, self.COL_STATUS, self.ROLE_STATUS_PERCENT)
         self._view.setItemDelegate(self._delegate)
+        self._view.tooltip_function = self.cell_tooltip
         self._view.setSelectionBehavior(QtWidgets.QTableView.SelectRows)
         self._view.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
 
@@ -299,6 +313,34 @@ class DataFrameModel(QtCore.QObject):
         self.dataframe = pandas.DataFrame({'filepath': []}, columns=index)
         # How many levels the dataframe's multiindex has:
         self.nlevels = self.dataframe.columns.nlevels
+        # Number of shots to add before next looking for string columns to store
+        # as categoricals and for columns to spill to disk:
+        self._shots_until_housekeeping = 16
+
+        # Columns larger than this many bytes are spilled to disk, see spill_column():
+        try:
+            self.spill_column_bytes = 1e6 * self.exp_config.getfloat('lyse', 'spill_column_megabytes')
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            self.spill_column_bytes = None
+        # Directory and filepaths of spilled columns, created when first needed:
+        self._spill_dir = None
+        self.spilled_columns = {}
+
+        # Rolling-window mode: keep at most this many shots, and/or shots at most
+        # this old, evicting older ones, see evict_rows():
+        try:
+            self.max_shots = self.exp_config.getint('lyse', 'max_shots')
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            self.max_shots = None
+        try:
+            self.max_shot_age = pandas.Timedelta(hours=self.exp_config.getfloat('lyse', 'max_shot_age_hours'))
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            self.max_shot_age = None
+        # Directory to save evicted rows to, if any:
+        try:
+            self.evicted_shots_archive = self.exp_config.get('lyse', 'evicted_shots_archive') or None
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            self.evicted_shots_archive = None
 
         status_item = QtGui.QStandardItem()
         status_item.setIcon(QtGui.QIcon(':qtutils/fugue/information'))
@@ -323,12 +365,15 @@ class DataFrameModel(QtCore.QObject):
         # Make the actions for the context menu:
         self.action_remove_selected = QtWidgets.QAction(
             QtGui.QIcon(':qtutils/fugue/minus'), 'Remove selected shots',  self._view)
+        self.action_show_memory_usage = QtWidgets.QAction(
+            QtGui.QIcon(':qtutils/fugue/memory'), 'Show dataframe memory usage',  self._view)
 
         self.connect_signals()
 
     def connect_signals(self):
         self._view.customContextMenuRequested.connect(self.on_view_context_menu_requested)
         self.action_remove_selected.triggered.connect(self.on_remove_selection)
+        self.action_show_memory_usage.triggered.connect(self.on_show_memory_usage)
 
     def on_remove_selection(self):
         self.remove_selection()
@@ -341,14 +386,31 @@ class DataFrameModel(QtCore.QObject):
             return
         if confirm and not lyse.utils.gui.question_dialog(self.app, "Remove %d shots?" % len(selected_name_items)):
             return
-        # Remove from DataFrame first:
-        self.dataframe = self.dataframe.drop(index.row() for index in selected_indexes)
+        # Apply queued updates before removing rows, as in evict_rows():
+        self.flush_pending_updates()
+        rows = sorted(index.row() for index in selected_indexes)
+        removed_filepaths = self.dataframe['filepath'].values[rows]
+        # Remove from DataFrame first, in a single take of the remaining rows:
+        keep = np.ones(len(self.dataframe), dtype=bool)
+        keep[rows] = False
+        self.dataframe = self.dataframe.take(np.flatnonzero(keep))
         self.dataframe.index = pandas.Index(range(len(self.dataframe)))
-        # Delete one at a time from Qt model:
-        for name_item in selected_name_items:
-            row = name_item.row()
-            self._model.removeRow(row)
-        self.renumber_rows()
+        # Delete contiguous ranges of rows from the Qt model at once, in reverse
+        # order so that removals do not change the position of rows yet to be
+        # removed:
+        ranges = []
+        for row in rows:
+            if ranges and row == ranges[-1][0] + ranges[-1][1]:
+                ranges[-1][1] += 1
+            else:
+                ranges.append([row, 1])
+        for start, count in reversed(ranges):
+            self._model.removeRows(start, count)
+        for filepath in removed_filepaths:
+            del self.row_number_by_filepath[filepath]
+        self.remove_spilled(removed_filepaths)
+        # Rows before the first removed one are unaffected:
+        self.renumber_rows(add_from=rows[0])
 
     def mark_selection_not_done(self):
         selected_indexes = self._view.selectedIndexes()
@@ -373,8 +435,21 @@ class DataFrameModel(QtCore.QObject):
     def on_view_context_menu_requested(self, point):
         menu = QtWidgets.QMenu(self._view)
         menu.addAction(self.action_remove_selected)
+        menu.addAction(self.action_show_memory_usage)
         menu.exec(QtGui.QCursor.pos())
 
+    def on_show_memory_usage(self):
+        usage = self.memory_usage_by_group()
+        lines = ['Dataframe memory usage ({} shots):'.format(len(self.dataframe))]
+        for group, nbytes in usage.items():
+            lines.append('  {:>10.3f} MB  {}'.format(nbytes / 1e6, group))
+        lines.append('  {:>10.3f} MB  total'.format(usage.sum() / 1e6))
+        if self.spilled_columns:
+            lines.append('Spilled to disk: ' + ', '.join(
+                '/'.join(s for s in column_name if s) for column_name in self.spilled_columns
+            ))
+        self.app.output_box.output('\n'.join(lines) + '\n')
+
     def on_double_click(self, index):
         filepath_item = self._model.item(index.row(), self.COL_FILEPATH)
         shot_filepath = filepath_item.text()
@@ -423,6 +498,10 @@ class DataFrameModel(QtCore.QObject):
                 column_names[column_index] = new_column_name
             self.column_indices = column_indices
             self.column_names = column_names
+            self.spilled_columns = {
+                column_name + ('',) * extra_levels: filepath
+                for column_name, filepath in self.spilled_columns.items()
+            }
 
     @inmain_decorator()
     def mark_as_deleted_off_disk(self, filepath):
@@ -446,22 +525,35 @@ class DataFrameModel(QtCore.QObject):
         status_item.setIcon(QtGui.QIcon(':qtutils/fugue/drive--minus'))
         self.app.output_box.output('Warning: Shot deleted from disk or no longer readable %s\n' % filepath, red=True)
 
+    def queue_row_update(self, filepath, updated_row_data):
+        """Queue an update to a row, to be applied along with any other pending
+        updates at most UPDATE_INTERVAL_MS later. May be called from any thread.
+        This allows results arriving at a high rate to be applied to the model in
+        batches rather than blocking the calling thread on the GUI for each one.
+        Code that reads the dataframe and needs it to be up to date must first call
+        flush_pending_updates()."""
+        with self._pending_updates_lock:
+            self._pending_updates.setdefault(filepath, {}).update(updated_row_data)
+            flush_scheduled = self._flush_scheduled
+            self._flush_scheduled = True
+        if not flush_scheduled:
+            inmain_later(QtCore.QTimer.singleShot, self.UPDATE_INTERVAL_MS, self.flush_pending_updates)
+
     @inmain_decorator()
-    def infer_objects(self):
-        """Convert columns in the dataframe with dtype 'object' into compatible, more
-        specific types, if possible. This improves pickling performance and ensures
-        multishot analysis code does not encounter columns with dtype 'object' for
-        non-mixed numerical data, which it might choke on.
-        """
-        self.dataframe = self.dataframe.infer_objects()
+    def flush_pending_updates(self):
+        """Apply all row updates queued with queue_row_update() to the dataframe and
+        Qt model"""
+        with self._pending_updates_lock:
+            pending_updates = self._pending_updates
+            self._pending_updates = {}
+            self._flush_scheduled = False
+        for filepath, updated_row_data in pending_updates.items():
+            self.update_row(filepath, updated_row_data=updated_row_data)
 
     @inmain_decorator()
     def update_row(self, filepath, dataframe_already_updated=False, new_row_data=None, updated_row_data=None):
         """"Updates a row in the dataframe and Qt model to the data in the HDF5 file for
         that shot."""
-        # To speed things up block signals to the model during update
-        self._model.blockSignals(True)
-
         # Update the row in the dataframe first:
         if (new_row_data is None) == (updated_row_data is None) and not dataframe_already_updated:
             raise ValueError('Exactly one of new_row_data or updated_row_data must be provided')
@@ -479,19 +571,17 @@ class DataFrameModel(QtCore.QObject):
             for group, name in updated_row_data:
                 column_name = (group, name) + ('',) * (self.nlevels - 2)
                 value = updated_row_data[group, name]
-                try:
-                    self.dataframe.at[row_number, column_name] = value
-                except ValueError:
-                    # did the column not already exist when we tried to set an iterable?
-                    if not column_name in self.dataframe.columns:
-                        # create it with a non-iterable and then overwrite with the iterable value:
-                        self.dataframe.at[row_number, column_name] = None
-                    else:
-                        # Incompatible datatype - convert the datatype of the column to
-                        # 'object'
-                        self.dataframe[column_name] = self.dataframe[column_name].astype('object')
-                    # Now that the column exists and has dtype object, we can set the value:
-                    self.dataframe.at[row_number, column_name] = value
+                # Create or convert the column explicitly with the dtype required to
+                # hold the value, rather than letting pandas upcast it to object:
+                if column_name in self.dataframe.columns:
+                    dtype = self.dataframe[column_name].dtype
+                    new_dtype = promoted_dtype(dtype, value)
+                    if new_dtype != dtype:
+                        self.dataframe[column_name] = self.dataframe[column_name].astype(new_dtype)
+                else:
+                    new_dtype = promoted_dtype(None, value)
+                    self.dataframe[column_name] = pandas.Series(index=self.dataframe.index, dtype=new_dtype)
+                self.dataframe.at[row_number, column_name] = value
 
             dataframe_already_updated = True
 
@@ -502,6 +592,28 @@ class DataFrameModel(QtCore.QObject):
             self.dataframe = replace_with_padding(self.dataframe, new_row_data, row_number)
             self.update_column_levels()
 
+        new_column_numbers = self._update_columns()
+
+        # Update the data in the Qt model:
+        column_numbers = []
+        for column_number, column_name in self.column_names.items():
+            if not isinstance(column_name, tuple):
+                # One of our special columns, does not correspond to a column in the dataframe:
+                continue
+            if updated_row_data is not None:
+                # Must remove empty strings from tuple to compare with updated_row_data:
+                if tuple(s for s in column_name if s) not in updated_row_data:
+                    continue
+            column_numbers.append(column_number)
+        self._render_cells(row_number, row_number + 1, column_numbers)
+
+        for column_number in new_column_numbers:
+            # Resize any new columns to fit contents:
+            self._view.resizeColumnToContents(column_number)
+
+    def _update_columns(self):
+        """Add and remove columns of the Qt model to match those of the dataframe.
+        Returns the column numbers of any new columns."""
         # Check and create necessary new columns in the Qt model:
         new_column_names = set(self.dataframe.columns) - set(self.column_names.values())
         new_columns_start = self._model.columnCount()
@@ -547,48 +659,62 @@ class DataFrameModel(QtCore.QObject):
             # Update the inverse mapping of self.column_names:
             self.column_indices = {name: index for index, name in self.column_names.items()}
 
-        # Update the data in the Qt model:
-        dataframe_row = self.dataframe.iloc[row_number].to_dict()
-        for column_number, column_name in self.column_names.items():
-            if not isinstance(column_name, tuple):
-                # One of our special columns, does not correspond to a column in the dataframe:
-                continue
-            if updated_row_data is not None:
-                # Must remove empty strings from tuple to compare with updated_row_data:
-                if tuple(s for s in column_name if s) not in updated_row_data:
-                    continue
-            value = dataframe_row[column_name]
-            if isinstance(value, float):
-                value_str = lyse.utils.gui.scientific_notation(value)
-            else:
-                value_str = str(value)
-            lines = value_str.splitlines()
-            if len(lines) > 1:
-                short_value_str = lines[0] + ' ...'
-            else:
-                short_value_str = value_str
-
-            item = self._model.item(row_number, column_number)
-            if item is None:
-                # This is the first time we've written a value to this part of the model:
-                item = QtGui.QStandardItem(short_value_str)
-                item.setData(QtCore.Qt.AlignCenter, QtCore.Qt.TextAlignmentRole)
-                self._model.setItem(row_number, column_number, item)
-            else:
-                item.setText(short_value_str)
-            item.setToolTip(repr(value))
-
-        for i, column_name in enumerate(sorted(new_column_names)):
-            # Resize any new columns to fit contents:
-            column_number = new_columns_start + i
-            self._view.resizeColumnToContents(column_number)
-
         if new_column_names or defunct_column_names:
             self.columns_changed.emit()
 
-        # unblock signals to the model and tell it to update
+        # Any new columns are at the end, after removal of the defunct ones:
+        n_columns = self._model.columnCount()
+        return list(range(n_columns - len(new_column_names), n_columns))
+
+    def _render_cells(self, start, stop, column_numbers):
+        """Set the text of the Qt model's items in rows start to stop (exclusive)
+        and the given columns from the dataframe. Values are formatted a column at
+        a time. To speed things up, signals to the model are blocked whilst
+        setting items, and then a single dataChanged signal is emitted spanning
+        the modified cells."""
+        if not column_numbers or start >= stop:
+            return
+        self._model.blockSignals(True)
+        for column_number in column_numbers:
+            column = self.dataframe[self.column_names[column_number]].iloc[start:stop]
+            if column.dtype.kind == 'f':
+                values = column.to_numpy()
+            else:
+                # Iterate the Series rather than its .values, so that extension
+                # types such as timezone-aware timestamps keep their scalar type:
+                values = list(column)
+            value_strs = lyse.utils.gui.scientific_notation_array(values)
+            for row_number, value_str in zip(range(start, stop), value_strs):
+                lines = value_str.splitlines()
+                if len(lines) > 1:
+                    short_value_str = lines[0] + ' ...'
+                else:
+                    short_value_str = value_str
+
+                item = self._model.item(row_number, column_number)
+                if item is None:
+                    # This is the first time we've written a value to this part of the model:
+                    item = QtGui.QStandardItem(short_value_str)
+                    item.setData(QtCore.Qt.AlignCenter, QtCore.Qt.TextAlignmentRole)
+                    self._model.setItem(row_number, column_number, item)
+                else:
+                    item.setText(short_value_str)
         self._model.blockSignals(False)
-        self._model.layoutChanged.emit()
+        self._model.dataChanged.emit(self._model.index(start, min(column_numbers)),
+                                     self._model.index(stop - 1, max(column_numbers)))
+
+    def cell_tooltip(self, row_number, column_number):
+        """Return the tooltip for a cell of the Qt model - the repr of the value in
+        the dataframe - or None for cells that have no value from the dataframe."""
+        column_name = self.column_names.get(column_number)
+        if not isinstance(column_name, tuple) or row_number >= len(self.dataframe):
+            return None
+        if self._model.item(row_number, column_number) is None:
+            return None
+        value = self.dataframe[column_name].iloc[row_number]
+        if isinstance(value, np.generic):
+            value = value.item()
+        return repr(value)
 
     @inmain_decorator()
     def set_status_percent(self, filepath, status_percent):
@@ -612,42 +738,51 @@ class DataFrameModel(QtCore.QObject):
         return [status_item, name_item]
 
     def renumber_rows(self, add_from=0):
-        """Add/update row indices - the rows are numbered in simple sequential
-        order for easy comparison with the dataframe. add_from allows you to
-        only add numbers for new rows from the given index as a performance
-        optimisation, though if the number of digits changes, all rows will
-        still be renumbered. add_from should not be used if rows have been
-        deleted."""
-        n_digits = len(str(self._model.rowCount()))
+        """Update row_number_by_filepath and the vertical header labels for rows
+        from add_from onwards - the rows are numbered in simple sequential order
+        for easy comparison with the dataframe. The labels themselves are computed
+        on demand by vertical_header_text(), so this only tells the view which
+        ones have changed. If the number of digits changes, all labels are
+        updated. If rows have been deleted, add_from must be no greater than the
+        first deleted row, and the deleted rows' filepaths must already have been
+        removed from row_number_by_filepath."""
+        n_rows = self._model.rowCount()
+        if add_from == 0:
+            self.row_number_by_filepath = {}
+        filepaths = self.dataframe['filepath'].values[add_from:]
+        self.row_number_by_filepath.update(zip(filepaths, range(add_from, n_rows)))
+
+        n_digits = len(str(n_rows))
         if n_digits != self._previous_n_digits:
             # All labels must be updated:
             add_from = 0
         self._previous_n_digits = n_digits
-
-        if add_from == 0:
-            self.row_number_by_filepath = {}
-
-        for row_number in range(add_from, self._model.rowCount()):
-            vertical_header_item = self._model.verticalHeaderItem(row_number)
-            row_number_str = str(row_number).rjust(n_digits)
-            vert_header_text = '{}. '.format(row_number_str)
-            filepath_item = self._model.item(row_number, self.COL_FILEPATH)
-            filepath = filepath_item.text()
-            self.row_number_by_filepath[filepath] = row_number
-            if self.integer_indexing:
-                header_cols = ['sequence_index', 'run number', 'run repeat']
-                header_strings = []
-                for col in header_cols:
-                    val = self.dataframe[col].values[row_number]
-                    if pandas.notna(val):
-                        header_strings.append('{:04d}'.format(val))
-                    else:
-                        header_strings.append('----')
-                vert_header_text += ' | '.join(header_strings)
-            else:
-                basename = os.path.splitext(os.path.basename(filepath))[0]
-                vert_header_text += basename
-            vertical_header_item.setText(vert_header_text)
+        if add_from < n_rows:
+            self._model.headerDataChanged.emit(QtCore.Qt.Vertical, add_from, n_rows - 1)
+
+    def vertical_header_text(self, row_number):
+        """Return the vertical header label for a row: its row number, followed by
+        either the shot's sequence index, run number and run repeat (if integer
+        indexing is in use) or its filename"""
+        if row_number >= len(self.dataframe):
+            # The Qt model can briefly have rows that the dataframe does not:
+            return None
+        n_digits = len(str(self._model.rowCount()))
+        vert_header_text = '{}. '.format(str(row_number).rjust(n_digits))
+        if self.integer_indexing:
+            header_cols = ['sequence_index', 'run number', 'run repeat']
+            header_strings = []
+            for col in header_cols:
+                val = self.dataframe[col].values[row_number]
+                if pandas.notna(val):
+                    header_strings.append('{:04d}'.format(int(val)))
+                else:
+                    header_strings.append('----')
+            vert_header_text += ' | '.join(header_strings)
+        else:
+            filepath = self.dataframe['filepath'].values[row_number]
+            vert_header_text += os.path.splitext(os.path.basename(filepath))[0]
+        return vert_header_text
     
     @inmain_decorator()
     def add_files(self, filepaths, new_row_data, done=False):
@@ -673,37 +808,259 @@ class DataFrameModel(QtCore.QObject):
             # Update the dataframe:
             self.dataframe = concat_with_padding(self.dataframe, new_row_data)
             self.update_column_levels()
+            self._shots_until_housekeeping -= len(to_add)
+            if self._shots_until_housekeeping <= 0:
+                # Checking every column is O(N), so only do it once as many shots
+                # have been added as there are rows. This is each time the number of
+                # rows doubles, or every max_shots shots in rolling-window mode. In
+                # between, concat_with_padding() keeps existing categorical columns
+                # categorical:
+                self.housekeeping()
+                self._shots_until_housekeeping = len(self.dataframe)
 
         self.app.filebox.set_add_shots_progress(None, None, "updating filebox")
 
         for filepath in to_add:
             # Add the new rows to the Qt model:
             self._model.appendRow(self.new_row(filepath, done=done))
-            vert_header_item = QtGui.QStandardItem('...loading...')
-            self._model.setVerticalHeaderItem(self._model.rowCount() - 1, vert_header_item)
             self._view.resizeRowToContents(self._model.rowCount() - 1)
 
         self.renumber_rows(add_from=self._model.rowCount()-len(to_add))
 
-        # Update the Qt model:
-        for filepath in to_add:
-            self.update_row(filepath, dataframe_already_updated=True)
+        # Update the Qt model, formatting the new rows a column at a time:
+        if to_add:
+            new_column_numbers = self._update_columns()
+            column_numbers = [column_number for column_number, column_name in self.column_names.items()
+                              if isinstance(column_name, tuple)]
+            self._render_cells(self._model.rowCount() - len(to_add), self._model.rowCount(), column_numbers)
+            for column_number in new_column_numbers:
+                # Resize any new columns to fit contents:
+                self._view.resizeColumnToContents(column_number)
+
+        if to_add:
+            self.evict_rows()
 
         self.app.filebox.set_add_shots_progress(None, None, None)        
             
 
+    def housekeeping(self):
+        """Store repetitive string columns as categoricals, and spill columns larger
+        than spill_column_bytes to disk."""
+        categorize_columns(self.dataframe)
+        if self.spill_column_bytes is None:
+            return
+        usage = self.dataframe.memory_usage(deep=True, index=False)
+        globals_columns = set(get_globals_columns(self.dataframe))
+        for column_name, nbytes in usage.items():
+            if nbytes <= self.spill_column_bytes and column_name not in self.spilled_columns:
+                # Columns that were spilled before and have been created again (for
+                # example by re-running a routine) are spilled whatever their size,
+                # so that their values are not split between disk and dataframe:
+                continue
+            if column_name[0] in SHOT_ATTRIBUTE_COLUMNS or column_name in globals_columns:
+                # Needed for indexing and grouping shots, never spill:
+                continue
+            self.spill_column(column_name)
+
+    @inmain_decorator()
+    def memory_usage_by_group(self):
+        """Return the memory used by the dataframe in bytes, summed over groups of
+        columns: each analysis routine's results group, each image orientation,
+        'globals' and 'shot attributes' (filepaths, sequence, run number etc).
+
+        Returns:
+            :obj:`pandas:pandas.Series`: bytes per group, largest first.
+        """
+        usage = self.dataframe.memory_usage(deep=True, index=False)
+        globals_columns = set(get_globals_columns(self.dataframe))
+        groups = {}
+        for column_name, nbytes in usage.items():
+            if column_name[0] in SHOT_ATTRIBUTE_COLUMNS:
+                group = 'shot attributes'
+            elif column_name in globals_columns:
+                group = 'globals'
+            else:
+                group = column_name[0]
+            groups[group] = groups.get(group, 0) + nbytes
+        return pandas.Series(groups, dtype=np.int64).sort_values(ascending=False)
+
+    @inmain_decorator()
+    def spill_column(self, column_name):
+        """Move a column out of the dataframe into a pickle file on disk. The
+        values are kept by filepath, so they can be retrieved with get_spilled()
+        or moved back with unspill_column(), and are merged back into the
+        dataframe served to multishot routines by dataframe_with_spilled(). If
+        the column is created again (for example when a routine is re-run), the
+        new values are merged with those already on disk at the next
+        housekeeping(), and until then take precedence over them. Values for
+        shots no longer in the dataframe are discarded."""
+        filepaths = self.dataframe['filepath'].values
+        series = pandas.Series(self.dataframe[column_name].values, index=filepaths)
+        series = series[series.notna()]
+        if column_name in self.spilled_columns:
+            old_series = pandas.read_pickle(self.spilled_columns[column_name])
+            old_series = old_series[old_series.index.isin(filepaths) & ~old_series.index.isin(series.index)]
+            series = pandas.concat([old_series, series])
+        else:
+            if self._spill_dir is None:
+                self._spill_dir = tempfile.TemporaryDirectory(prefix='lyse-spilled-')
+            filename = 'column_{}.pkl'.format(len(self.spilled_columns))
+            self.spilled_columns[column_name] = os.path.join(self._spill_dir.name, filename)
+        series.to_pickle(self.spilled_columns[column_name])
+        self.dataframe = self.dataframe.drop(columns=[column_name])
+        # The column is removed from the Qt model the next time a row is updated.
+
+    def remove_spilled(self, filepaths):
+        """Delete the values of spilled columns for shots that have been removed
+        from the dataframe, so that spill files do not grow without bound."""
+        for spill_path in self.spilled_columns.values():
+            series = pandas.read_pickle(spill_path)
+            removed = series.index.isin(filepaths)
+            if removed.any():
+                series[~removed].to_pickle(spill_path)
+
+    @inmain_decorator()
+    def get_spilled(self, column_name):
+        """Return the values of a spilled column for the shots currently in the
+        dataframe, as a Series aligned with the dataframe's rows."""
+        series = pandas.read_pickle(self.spilled_columns[column_name])
+        series = series.reindex(self.dataframe['filepath'].values)
+        series.index = self.dataframe.index
+        return series
+
+    @inmain_decorator()
+    def dataframe_with_spilled(self):
+        """Return a deep copy of the dataframe with any spilled columns merged back
+        in, as served to lyse.data(). Where a spilled column has been created again
+        in the dataframe, values set since it was spilled take precedence."""
+        self.flush_pending_updates()
+        df = self.dataframe.copy(deep=True)
+        for column_name in self.spilled_columns:
+            values = self.get_spilled(column_name)
+            if column_name in df.columns:
+                values = df[column_name].where(df[column_name].notna(), values)
+            df[column_name] = values
+        return df
+
+    @inmain_decorator()
+    def unspill_column(self, column_name):
+        """Move a spilled column back into the dataframe and delete it from disk."""
+        values = self.get_spilled(column_name)
+        if column_name in self.dataframe.columns:
+            # Values set since the column was spilled take precedence:
+            values = self.dataframe[column_name].where(self.dataframe[column_name].notna(), values)
+        self.dataframe[column_name] = values
+        os.unlink(self.spilled_columns.pop(column_name))
+
+    @inmain_decorator()
+    def evict_rows(self):
+        """In rolling-window mode, remove the oldest shots from the dataframe and Qt
+        model once there are more than max_shots of them, or once they are older
+        than max_shot_age. To amortise the cost of removing rows and renumbering the
+        remainder, shots are evicted in batches of about 10% of max_shots (or of the
+        current number of shots for max_shot_age). Only shots that have been
+        analysed are evicted: eviction stops at the first shot that has not,
+        so if analysis is paused or falling behind, the dataframe grows beyond
+        max_shots until it catches up. Evicted rows are saved to the
+        evicted_shots_archive directory, if set."""
+        # A shot's final results may still be queued after its status is set to
+        # done. Apply them, so that they are archived rather than lost:
+        self.flush_pending_updates()
+        n_rows = len(self.dataframe)
+        n_evict = 0
+        if self.max_shots is not None and n_rows > self.max_shots + self.max_shots // 10:
+            n_evict = n_rows - self.max_shots
+        if self.max_shot_age is not None and 'run time' in self.dataframe.columns.get_level_values(0):
+            run_times = pandas.to_datetime(self.dataframe['run time'], utc=True, errors='coerce')
+            expired = (run_times < pandas.Timestamp.now(tz='UTC') - self.max_shot_age).values
+            # Shots are in the order they were added, so only evict the leading run
+            # of expired shots:
+            n_expired = n_rows if expired.all() else int(expired.argmin())
+            if n_expired > n_rows // 10:
+                n_evict = max(n_evict, n_expired)
+        for row_number in range(n_evict):
+            status_item = self._model.item(row_number, self.COL_STATUS)
+            if status_item.data(self.ROLE_STATUS_PERCENT) != 100:
+                n_evict = row_number
+                break
+        if not n_evict:
+            return
+        evicted_rows = self.dataframe.iloc[:n_evict]
+        if self.evicted_shots_archive is not None:
+            self.archive_rows(evicted_rows)
+        self._model.removeRows(0, n_evict)
+        self.dataframe = self.dataframe.iloc[n_evict:]
+        self.dataframe.index = pandas.Index(range(len(self.dataframe)))
+        self.renumber_rows()
+        self.remove_spilled(evicted_rows['filepath'].values)
+
+    def archive_rows(self, rows):
+        """Save rows of the dataframe to a pickle file in the evicted_shots_archive
+        directory, named after the first and last shot in it. Values of spilled
+        columns for the rows are included."""
+        if self.spilled_columns:
+            rows = rows.copy()
+            for column_name, spill_path in self.spilled_columns.items():
+                values = pandas.read_pickle(spill_path).reindex(rows['filepath'].values).values
+                if column_name in rows.columns:
+                    values = rows[column_name].where(rows[column_name].notna(), values)
+                rows[column_name] = values
+        os.makedirs(self.evicted_shots_archive, exist_ok=True)
+        basenames = [os.path.splitext(os.path.basename(path))[0] for path in rows['filepath'].values[[0, -1]]]
+        filename = 'evicted_{}_to_{}.pkl'.format(*basenames)
+        rows.to_pickle(os.path.join(self.evicted_shots_archive, filename))
+
+    @inmain_decorator()
+    def get_flat_dict(self, filepath):
+        """Return a shot's row of the dataframe as a flat dictionary, in the format
+        returned by dataframe_utilities.get_flat_dict_from_shot(): keys are tuples
+        without padding, and only columns the shot has a value for are included
+        (except for shot attributes, which are always included). Returns None if
+        the shot is not in the dataframe, or if any columns have been spilled to
+        disk, in which case the row is incomplete."""
+        self.flush_pending_updates()
+        if self.spilled_columns:
+            return None
+        try:
+            row_number = self.row_number_by_filepath[filepath]
+        except KeyError:
+            return None
+        flat_dict = {}
+        for column_name, value in self.dataframe.iloc[row_number].items():
+            if column_name[0] not in SHOT_ATTRIBUTE_COLUMNS:
+                if pandas.api.types.is_scalar(value) and pandas.isna(value):
+                    # Column for data from other shots:
+                    continue
+            flat_dict[tuple(s for s in column_name if s)] = value
+        return flat_dict
+
     @inmain_decorator()
     def get_first_incomplete(self):
         """Returns the filepath of the first shot in the model that has not
         been analysed"""
+        incomplete = self.get_incomplete(1)
+        if incomplete:
+            return incomplete[0]
+
+    @inmain_decorator()
+    def get_incomplete(self, n):
+        """Returns the filepaths of up to n shots in the model that have not been
+        analysed, in the order they will be analysed"""
+        filepaths = []
         for row in range(self._model.rowCount()):
+            if len(filepaths) == n:
+                break
             status_item = self._model.item(row, self.COL_STATUS)
             if status_item.data(self.ROLE_STATUS_PERCENT) != 100:
                 filepath_item = self._model.item(row, self.COL_FILEPATH)
-                return filepath_item.text()
+                filepaths.append(filepath_item.text())
+        return filepaths
 
 class FileBox(object):
 
+    # Size of reads when prefetching shot files:
+    PREFETCH_CHUNK_SIZE = 1 << 20
+
     def __init__(self, app, container, exp_config, to_singleshot, from_singleshot, to_multishot, from_multishot):
         self.app = app
 
@@ -750,6 +1107,20 @@ class FileBox(object):
         self.incoming.daemon = True
         self.incoming.start()
 
+        # How many shots after the one being analysed to read in advance, so that
+        # they are in the OS page cache by the time they are analysed:
+        try:
+            self.n_prefetch = self.exp_config.getint('lyse', 'prefetch_shots')
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            self.n_prefetch = 1
+        self.prefetch_queue = queue.Queue()
+        # Recently queued shots, to avoid reading the same file repeatedly:
+        self.recently_prefetched = collections.deque(maxlen=max(4 * self.n_prefetch, 1))
+        if self.n_prefetch:
+            self.prefetch = threading.Thread(target=self.prefetch_loop)
+            self.prefetch.daemon = True
+            self.prefetch.start()
+
         self.analysis = threading.Thread(target = self.analysis_loop)
         self.analysis.daemon = True
         self.analysis.start()
@@ -877,7 +1248,11 @@ class FileBox(object):
                 indices_of_files_not_found = []
                 for i, filepath in enumerate(filepaths):
                     try:
-                        dataframe = get_dataframe_from_shot(filepath)
+                        # Create the row with as many column levels as the
+                        # filebox's dataframe so it doesn't need padding later.
+                        # Run times are parsed for the whole batch at once below:
+                        dataframe = get_dataframe_from_shot(filepath, self.shots_model.nlevels,
+                                                            parse_run_time=False)
                         dataframes.append(dataframe)
                     except IOError:
                         self.app.output_box.output('Warning: Ignoring shot file not found or not readable %s\n' % filepath, red=True)
@@ -889,6 +1264,7 @@ class FileBox(object):
                 self.set_add_shots_progress(n_shots_added, total_shots, "concatenating dataframes")
                 if dataframes:
                     new_row_data = concat_with_padding(*dataframes)
+                    parse_run_times(new_row_data)
                 else:
                     new_row_data = None
 
@@ -924,8 +1300,14 @@ class FileBox(object):
                 at_least_one_shot_analysed = False
                 while True:
                     if not self.analysis_paused:
-                        # Find the first shot that has not finished being analysed:
-                        filepath = self.shots_model.get_first_incomplete()
+                        # Find the first shot that has not finished being analysed,
+                        # and the ones after it to prefetch:
+                        incomplete = self.shots_model.get_incomplete(1 + self.n_prefetch)
+                        filepath = incomplete[0] if incomplete else None
+                        for prefetch_filepath in incomplete[1:]:
+                            if prefetch_filepath not in self.recently_prefetched:
+                                self.recently_prefetched.append(prefetch_filepath)
+                                self.prefetch_queue.put(prefetch_filepath)
                         if filepath is not None:
                             logger.info('analysing: %s'%filepath)
                             self.do_singleshot_analysis(filepath)
@@ -956,6 +1338,22 @@ class FileBox(object):
                 self.pause_analysis()
             
    
+    def prefetch_loop(self):
+        """Read shot files queued for prefetching, discarding the data. This
+        overlaps the latency of reading them (from a network share, say) with
+        analysis of earlier shots, since subsequent reads by h5py in the analysis
+        routines are then served from the OS page cache."""
+        while True:
+            filepath = self.prefetch_queue.get()
+            try:
+                with open(filepath, 'rb') as f:
+                    while f.read(self.PREFETCH_CHUNK_SIZE):
+                        pass
+            except OSError:
+                # Deleted or unreadable. Not our problem, the analysis loop will
+                # report it when it gets to this shot:
+                continue
+
     @inmain_decorator()
     def pause_analysis(self):
         # This automatically triggers the slot that sets self.analysis_paused
@@ -977,7 +1375,7 @@ class FileBox(object):
             signal, status_percent, updated_data = self.from_singleshot.get()
             for file in updated_data:
                 # Update the data for all the rows with new data:
-                self.shots_model.update_row(file, updated_row_data=updated_data[file])
+                self.shots_model.queue_row_update(file, updated_data[file])
             # Update the status percent for the the row on which analysis is actually
             # running:
             if status_percent is not None:
@@ -997,11 +1395,14 @@ class FileBox(object):
             raise ValueError('invalid signal %s' % str(signal))
                         
     def do_multishot_analysis(self):
+        # Multishot routines get the dataframe via the WebServer, which flushes
+        # pending updates itself, but flush now so the view is up to date too:
+        self.shots_model.flush_pending_updates()
         self.to_multishot.put(None)
         while True:
             signal, _, updated_data = self.from_multishot.get()
             for file in updated_data:
-                self.shots_model.update_row(file, updated_row_data=updated_data[file])
+                self.shots_model.queue_row_update(file, updated_data[file])
             if signal == 'done':
                 self.multishot_required = False
                 return
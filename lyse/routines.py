@@ -22,11 +22,12 @@ import threading
 import subprocess
 
 # Labscript imports
+from labscript_utils.labconfig import LabConfig
 from labscript_utils.qtwidgets.headerview_with_widgets import HorizontalHeaderViewWithWidgets
 
 # qt imports
 from qtutils.qt import QtCore, QtGui, QtWidgets
-from qtutils import inmain_decorator, UiLoader, DisconnectContextManager
+from qtutils import inmain_decorator, inmain_later, UiLoader, DisconnectContextManager
 
 import lyse.widgets
 import lyse.utils
@@ -53,6 +54,15 @@ class RoutineBox(object):
         self.from_filebox = from_filebox
         self.to_filebox = to_filebox
         self.output_box_port = output_box_port
+
+        # Whether to send single-shot workers the shot's row of the dataframe along
+        # with each shot, so that lyse.data(path) does not need to read the file.
+        # Off by default, as values from the dataframe can differ from those in the
+        # file (see lyse.data()):
+        try:
+            self.send_shot_data = exp_config.getboolean('lyse', 'send_shot_data_to_workers')
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            self.send_shot_data = False
         
         self.logger = logging.getLogger('lyse.RoutineBox.%s'%('multishot' if multishot else 'singleshot'))
         self.logger.info('starting')
@@ -163,10 +173,13 @@ class RoutineBox(object):
         tuples containing the filepath and whether the routine is enabled or
         not when it is added. if clear_existing == True, then any existing
         analysis routines will be cleared before the new ones are added."""
+        # self.routines is read by the analysis thread, so it is replaced with a new
+        # list rather than modified in place, such that the analysis thread always
+        # sees a consistent snapshot of the routines and their order.
         if clear_existing:
-            for routine in self.routines[:]:
+            for routine in self.routines:
                 routine.remove()
-                self.routines.remove(routine)
+            self.routines = []
 
         # Queue the files to be opened:
         for filepath, checked in routine_files:
@@ -176,7 +189,7 @@ class RoutineBox(object):
             self.logger.info(f'adding routine for {filepath}')
             routine = AnalysisRoutine(self.app, filepath, self.model, self.output_box_port,
                                       QtCore.Qt.CheckState(checked))
-            self.routines.append(routine)
+            self.routines = self.routines + [routine]
         self.update_select_all_checkstate()
         
     def on_treeview_double_left_clicked(self, index):
@@ -216,15 +229,22 @@ class RoutineBox(object):
             return
         name_items = [self.model.item(row, self.COL_NAME) for row in selected_rows]
         filepaths = [item.data(self.ROLE_FULLPATH) for item in name_items]
-        for routine in self.routines[:]:
+        for routine in self.routines:
             if routine.filepath in filepaths:
                 routine.remove()
-                self.routines.remove(routine)
                 self.logger.info(f'removing routine for {routine.filepath}')
+        self.routines = [routine for routine in self.routines if routine.filepath not in filepaths]
         self.update_select_all_checkstate()
         
     def on_model_item_changed(self, item):
         if item.column() == self.COL_ACTIVE:
+            # Mirror the check state into the routine, where the analysis thread
+            # can read it without going via the main thread:
+            name_item = self.model.item(item.row(), self.COL_NAME)
+            fullpath = name_item.data(self.ROLE_FULLPATH)
+            for routine in self.routines:
+                if routine.filepath == fullpath:
+                    routine.set_enabled(item.checkState() == QtCore.Qt.Checked)
             self.update_select_all_checkstate()
         
     def on_select_all_state_changed(self, state):
@@ -236,6 +256,8 @@ class RoutineBox(object):
             for row in range(self.model.rowCount()):
                 active_item = self.model.item(row, self.COL_ACTIVE)
                 active_item.setCheckState(state)
+        for routine in self.routines:
+            routine.set_enabled(state == QtCore.Qt.Checked)
         
     def on_treeView_context_menu_requested(self, point):
         menu = QtWidgets.QMenu(self.ui.treeView)
@@ -341,21 +363,33 @@ class RoutineBox(object):
             self.logger.info('got a file to process: %s'%filepath)
             self.do_analysis(filepath)
     
-    def todo(self):
+    def todo(self, routines=None):
         """How many analysis routines are not done?"""
-        return len([r for r in self.routines if r.enabled() and not r.done])
+        if routines is None:
+            routines = self.routines
+        return len([r for r in routines if r.enabled() and not r.done])
         
     def do_analysis(self, filepath):
         """Run all analysis routines once on the given filepath,
         which is a shot file if we are a singleshot routine box"""
-        for routine in self.routines:
+        # Routines' enabled state and order are read from thread-safe snapshots
+        # rather than from the Qt model, so this does not wait on the main thread
+        # except to run the routines themselves. Take a fresh snapshot of the list
+        # of routines each step to pick up additions, removals and reordering:
+        routines = self.routines
+        for routine in routines:
             routine.set_status('clear')
-        remaining = self.todo()
+        remaining = self.todo(routines)
         error = False
         updated_data = {}
+        if self.multishot or not self.send_shot_data:
+            shot_data = None
+        else:
+            shot_data = self.app.filebox.shots_model.get_flat_dict(filepath)
         while remaining:
             self.logger.debug('%d routines left to do'%remaining)
-            for routine in self.routines:
+            routines = self.routines
+            for routine in routines:
                 if routine.enabled() and not routine.done:
                     break
             else:
@@ -363,7 +397,10 @@ class RoutineBox(object):
             if routine is not None:
                 self.logger.info('running analysis routine %s'%routine.shortname)
                 routine.set_status('working')
-                success, updated_data = routine.do_analysis(filepath)
+                success, updated_data = routine.do_analysis(filepath, shot_data)
+                if shot_data is not None:
+                    # Later routines should see results saved by this one:
+                    shot_data.update(updated_data.get(filepath, {}))
                 if success:
                     routine.set_status('done')
                     self.logger.debug('success')
@@ -374,8 +411,9 @@ class RoutineBox(object):
                     break
             # Race conditions here, but it's only for reporting percent done
             # so it doesn't matter if it's wrong briefly:
-            remaining = self.todo()
-            total = len([r for r in self.routines if r.enabled()])
+            routines = self.routines
+            remaining = self.todo(routines)
+            total = len([r for r in routines if r.enabled()])
             done = total - remaining
             try:
                 status_percent = 100*float(done)/(remaining + done)
@@ -429,6 +467,9 @@ class AnalysisRoutine(object):
         
         self.error = False
         self.done = False
+        # Mirror of the check state of the routine's row in the model, so the
+        # analysis thread can check it without going via the main thread:
+        self._enabled = (checked == QtCore.Qt.Checked)
 
         self.logger = logging.getLogger(f'lyse.AnalysisRoutine.{self.shortname}')
 
@@ -445,26 +486,21 @@ class AnalysisRoutine(object):
         name_item.setToolTip(self.filepath)
         name_item.setData(self.filepath, self.ROLE_FULLPATH)
         self.model.appendRow([active_item, info_item, name_item])
+        # Tracks the row as the model is sorted or rows are removed, for fast lookup:
+        self._name_index = QtCore.QPersistentModelIndex(name_item.index())
             
         self.exiting = False
         
     def start_worker(self):
-        # Start a worker process for this analysis routine:
-        worker_path = os.path.join(lyse.utils.LYSE_DIR, 'analysis_subprocess.py')
-
-        child_handles = self.app.process_tree.subprocess(
-            worker_path,
-            output_redirection_port=self.output_box_port,
-            startup_timeout=30,
-        )
-        
-        to_worker, from_worker, worker = child_handles
+        # Get a worker process for this analysis routine, already started if the
+        # pool has an idle one:
+        to_worker, from_worker, worker = self.app.worker_pool.get_worker()
         # Tell the worker what script it with be executing:
         to_worker.put(self.filepath)
         return to_worker, from_worker, worker
         
-    def do_analysis(self, filepath):
-        self.to_worker.put(['analyse', filepath])
+    def do_analysis(self, filepath, shot_data=None):
+        self.to_worker.put(['analyse', (filepath, shot_data)])
         signal, data = self.from_worker.get()
         if signal == 'error':
             return False, data
@@ -473,48 +509,57 @@ class AnalysisRoutine(object):
         else:
             raise ValueError('invalid signal %s'%str(signal))
         
-    @inmain_decorator()
     def set_status(self, status):
-        index = self.get_row_index()
-        if index is None:
-            # Yelp, we've just been deleted. Nothing to do here.
-            return
-        status_item = self.model.item(index, self.COL_STATUS)
+        """Set the done and error flags for the given status, and update the
+        status icon in the main thread without waiting for it to do so. May be
+        called from any thread."""
         if status == 'done':
-            status_item.setIcon(QtGui.QIcon(':/qtutils/fugue/tick'))
             self.done = True
             self.error = False
         elif status == 'working':
-            status_item.setIcon(QtGui.QIcon(':/qtutils/fugue/hourglass'))
             self.done = False
             self.error = False
         elif status == 'error':
-            status_item.setIcon(QtGui.QIcon(':/qtutils/fugue/exclamation'))
             self.error = True
             self.done = False
         elif status == 'clear':
-            status_item.setData(None, QtCore.Qt.DecorationRole)
             self.done = False
             self.error = False
         else:
             raise ValueError(status)
-        
-    @inmain_decorator()
-    def enabled(self):
+        inmain_later(self.update_status_icon, status)
+
+    def update_status_icon(self, status):
         index = self.get_row_index()
         if index is None:
-            # Yelp, we've just been deleted.
-            return False
-        enabled_item = self.model.item(index, self.COL_ACTIVE)
-        return (enabled_item.checkState() == QtCore.Qt.Checked)
+            # Yelp, we've just been deleted. Nothing to do here.
+            return
+        status_item = self.model.item(index, self.COL_STATUS)
+        if status == 'done':
+            status_item.setIcon(QtGui.QIcon(':/qtutils/fugue/tick'))
+        elif status == 'working':
+            status_item.setIcon(QtGui.QIcon(':/qtutils/fugue/hourglass'))
+        elif status == 'error':
+            status_item.setIcon(QtGui.QIcon(':/qtutils/fugue/exclamation'))
+        elif status == 'clear':
+            status_item.setData(None, QtCore.Qt.DecorationRole)
+
+    def enabled(self):
+        """Whether the routine is checked as active in the routine box. Safe to
+        call from any thread."""
+        return self._enabled
+
+    def set_enabled(self, enabled):
+        """Update the mirrored check state, called by the RoutineBox whenever the
+        check state of this routine's row changes"""
+        self._enabled = enabled
         
     def get_row_index(self):
-        """Returns the row index for this routine's row in the model"""
-        for row in range(self.model.rowCount()):
-            name_item = self.model.item(row, self.COL_NAME)
-            fullpath = name_item.data(self.ROLE_FULLPATH)
-            if fullpath == self.filepath:
-                return row
+        """Returns the row index for this routine's row in the model, or None if it
+        has been removed"""
+        if not self._name_index.isValid():
+            return None
+        return self._name_index.row()
 
     def restart(self):
         # TODO set status to 'restarting' or an icon or something, and gray out the item?
@@ -522,6 +567,7 @@ class AnalysisRoutine(object):
         
     def remove(self):
         """End the child process and remove from the treeview"""
+        self._enabled = False
         self.end_child()
         index = self.get_row_index()
         if index is None:
@@ -564,4 +610,104 @@ class AnalysisRoutine(object):
         if restart:
             self.to_worker, self.from_worker, self.worker = self.start_worker()
             self.app.output_box.output('%s worker restarted\n'%self.shortname)
-        self.exiting = False
\ No newline at end of file
+        self.exiting = False
+
+
+class WorkerPool(object):
+    """A pool of idle analysis subprocesses, started in advance so that adding or
+    restarting an analysis routine does not have to wait for a new process to
+    start up and import Qt, matplotlib, h5py and so on. A worker does not know
+    which routine it will run until it is handed out by get_worker(), after
+    which the pool is replenished in the background."""
+
+    def __init__(self, app, output_box_port, size):
+        self.app = app
+        self.output_box_port = output_box_port
+        self.size = size
+        self.logger = logging.getLogger('lyse.WorkerPool')
+        self.lock = threading.Lock()
+        self.idle_workers = []
+        self.n_starting = 0
+        self.closed = False
+        # Idle workers that have been told to terminate, so that
+        # workers_terminated() can report on them:
+        self.terminated_workers = []
+        self.replenish()
+
+    def start_worker(self):
+        worker_path = os.path.join(lyse.utils.LYSE_DIR, 'analysis_subprocess.py')
+        return self.app.process_tree.subprocess(
+            worker_path,
+            output_redirection_port=self.output_box_port,
+            startup_timeout=30,
+        )
+
+    def replenish(self):
+        """Start workers in the background until the pool is full"""
+        with self.lock:
+            if self.closed:
+                return
+            n_to_start = self.size - len(self.idle_workers) - self.n_starting
+            if n_to_start <= 0:
+                return
+            self.n_starting += n_to_start
+        for _ in range(n_to_start):
+            thread = threading.Thread(target=self._add_worker)
+            thread.daemon = True
+            thread.start()
+
+    def _add_worker(self):
+        try:
+            child_handles = self.start_worker()
+        except Exception:
+            self.logger.exception('Failed to start idle worker')
+            child_handles = None
+        with self.lock:
+            self.n_starting -= 1
+            if child_handles is not None:
+                if self.closed:
+                    child_handles[2].terminate()
+                    self.terminated_workers.append(child_handles[2])
+                else:
+                    self.idle_workers.append(child_handles)
+
+    def get_worker(self):
+        """Return the to_worker, from_worker and worker handles of an idle worker,
+        or of a newly started one if there are none. The caller must send the
+        worker the path to the routine it is to run."""
+        child_handles = None
+        while child_handles is None:
+            with self.lock:
+                if not self.idle_workers:
+                    break
+                child_handles = self.idle_workers.pop(0)
+            worker = child_handles[2]
+            worker.poll()
+            if worker.returncode is not None:
+                # Died whilst idle:
+                child_handles = None
+        if child_handles is None:
+            child_handles = self.start_worker()
+        self.replenish()
+        return child_handles
+
+    def terminate(self):
+        """Terminate all idle workers and stop replenishing the pool"""
+        with self.lock:
+            self.closed = True
+            idle_workers = self.idle_workers
+            self.idle_workers = []
+        for _, _, worker in idle_workers:
+            # Idle workers are waiting for a routine filepath rather than for
+            # instructions, so can't be asked to quit:
+            worker.terminate()
+            self.terminated_workers.append(worker)
+
+    def workers_terminated(self):
+        """Return a dict of whether each idle worker that was terminated has
+        exited"""
+        terminated = {}
+        for i, worker in enumerate(self.terminated_workers):
+            worker.poll()
+            terminated['idle worker %d' % i] = worker.returncode is not None
+        return terminated
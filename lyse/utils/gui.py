@@ -13,6 +13,8 @@
 """Lyse GUI common utilities
 """
 
+import functools
+
 import numpy as np
 
 # qt imports
@@ -99,6 +101,26 @@ def scientific_notation(x, sigfigs=4, mode='eng'):
                 result += thinspace + times + thinspace + '10' + superscript
     return result
 
+@functools.lru_cache(maxsize=65536)
+def _cached_scientific_notation(x, sigfigs, mode):
+    return scientific_notation(x, sigfigs, mode)
+
+def scientific_notation_array(values, sigfigs=4, mode='eng'):
+    """Returns a list of display strings for a 1D array of values, such as a
+    column of the lyse dataframe. Floats are formatted with
+    scientific_notation() and other values with str(). Strings for each
+    distinct float are cached, and for arrays of dtype float each distinct value
+    is only looked up once, which is much faster than formatting every element
+    for columns that repeat the same values."""
+    if isinstance(values, np.ndarray) and values.dtype.kind == 'f':
+        unique_values, inverse = np.unique(values, return_inverse=True)
+        unique_strings = [_cached_scientific_notation(float(x), sigfigs, mode) for x in unique_values]
+        return [unique_strings[i] for i in inverse.ravel()]
+    return [
+        _cached_scientific_notation(value, sigfigs, mode) if isinstance(value, float) else str(value)
+        for value in values
+    ]
+
 def get_screen_geometry(qapplication):
     """Return the a list of the geometries of each screen: each a tuple of
     left, top, width and height"""
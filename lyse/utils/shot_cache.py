@@ -0,0 +1,202 @@
+#####################################################################
+#                                                                   #
+# /utils.shot_cache.py                                              #
+#                                                                   #
+# Copyright 2013, Monash University                                 #
+#                                                                   #
+# This file is part of the program lyse, in the labscript suite     #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Shared-memory cache of shot datasets for lyse analysis workers
+
+Single-shot routines run one after another on the same shot, each in its own
+worker process. With the cache enabled, the first worker to read an image or
+trace of the shot being analysed copies it into a named shared memory block, and
+workers for later routines map that block instead of reading the file again.
+
+Blocks are named deterministically from the path of the shot file and the
+dataset's path within it, so no coordination with the lyse parent process is
+required. The name does not depend on the file's size or modification time, as
+every routine writes its results to the file. The worker that created a block
+unlinks it when it moves on to a different shot, by which time the other
+routines have finished with that shot. Arrays returned from the cache are read-only views of
+the shared memory.
+
+Enable by setting ``shared_memory_cache = True`` in the ``[lyse]`` section of
+the labconfig.
+"""
+
+import os
+import ast
+import atexit
+import hashlib
+import struct
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from labscript_utils.labconfig import LabConfig
+
+import lyse.utils
+import lyse.utils.worker
+
+# Block layout: a ready flag and the length of the header, the header itself (the
+# repr of a dict of the dtype descr and shape, as in the .npy format), then the
+# data, aligned to _ALIGNMENT bytes:
+_PREFIX = struct.Struct('<II')
+_ALIGNMENT = 64
+# How long to wait for another worker to finish populating a block before giving
+# up and reading the file instead:
+_READY_TIMEOUT = 1
+
+_enabled = None
+_created = {}
+"""Blocks created by this process, by name"""
+_attached = {}
+"""Blocks created by other processes that this process has mapped, by name"""
+
+
+def enabled():
+    """Whether the cache is in use: running in a lyse analysis worker, with
+    ``[lyse] shared_memory_cache`` set in the labconfig."""
+    global _enabled
+    if not lyse.utils.worker.spinning_top:
+        return False
+    if _enabled is None:
+        try:
+            _enabled = lyse.utils.LABCONFIG.getboolean('lyse', 'shared_memory_cache')
+        except (LabConfig.NoOptionError, LabConfig.NoSectionError):
+            _enabled = False
+    return _enabled
+
+
+def is_current_shot(h5_path):
+    """Whether h5_path is the shot currently being analysed. Only datasets from
+    this shot are cached, so that a routine looping over many shots does not
+    fill shared memory."""
+    current_path = lyse.utils.worker.path
+    if current_path is None:
+        return False
+    return os.path.normcase(os.path.abspath(h5_path)) == os.path.normcase(os.path.abspath(current_path))
+
+
+def _block_name(h5_path, dataset_path):
+    # Only the current shot is cached (see is_current_shot()), so the path of the
+    # file identifies the shot. Routines modify the file as they save results, so
+    # its size and modification time must not be part of the name:
+    key = '\0'.join([os.path.normcase(os.path.abspath(h5_path)), dataset_path])
+    # Short, as some platforms limit the length of shared memory names:
+    return 'lyse_' + hashlib.sha1(key.encode('utf8')).hexdigest()[:24]
+
+
+def _as_array(shm):
+    ready, header_len = _PREFIX.unpack_from(shm.buf)
+    if not ready:
+        return None
+    header = ast.literal_eval(bytes(shm.buf[_PREFIX.size:_PREFIX.size + header_len]).decode('utf8'))
+    dtype = np.lib.format.descr_to_dtype(header['descr'])
+    offset = -(-(_PREFIX.size + header_len) // _ALIGNMENT) * _ALIGNMENT
+    array = np.ndarray(header['shape'], dtype=dtype, buffer=shm.buf, offset=offset)
+    array.flags.writeable = False
+    return array
+
+
+def _attach(name):
+    # Returns the array in an existing block, or None if there is no such block
+    # or it was not populated in time:
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return None
+    if os.name == 'posix':
+        # Only the creator should unlink the block, so stop the resource tracker
+        # from doing so when this process exits. There is no resource tracker on
+        # Windows, where the block is freed once all processes have closed it:
+        resource_tracker.unregister('/' + name, 'shared_memory')
+    deadline = time.monotonic() + _READY_TIMEOUT
+    while True:
+        array = _as_array(shm)
+        if array is not None:
+            _attached[name] = shm
+            return array
+        if time.monotonic() > deadline:
+            shm.close()
+            return None
+        time.sleep(0.001)
+
+
+def _publish(name, data):
+    # Copy data into a new block, returning a read-only view of it, or None if the
+    # block could not be created:
+    data = np.ascontiguousarray(data)
+    header = repr({'descr': np.lib.format.dtype_to_descr(data.dtype), 'shape': data.shape}).encode('utf8')
+    offset = -(-(_PREFIX.size + len(header)) // _ALIGNMENT) * _ALIGNMENT
+    try:
+        shm = shared_memory.SharedMemory(name=name, create=True, size=max(offset + data.nbytes, 1))
+    except (FileExistsError, OSError):
+        # Another worker beat us to it, or we are out of shared memory:
+        return None
+    _PREFIX.pack_into(shm.buf, 0, 0, len(header))
+    shm.buf[_PREFIX.size:_PREFIX.size + len(header)] = header
+    np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf, offset=offset)[...] = data
+    _PREFIX.pack_into(shm.buf, 0, 1, len(header))
+    _created[name] = shm
+    return _as_array(shm)
+
+
+def get_array(h5_path, dataset_path, read):
+    """Return the dataset at dataset_path in the shot file h5_path from the
+    cache, or call read() to read it from the file and add it to the cache.
+
+    Args:
+        h5_path (str): Path to the shot file.
+        dataset_path (str): Path of the dataset within the file, used to name
+            the cache entry.
+        read (callable): Function returning the dataset as an array.
+
+    Returns:
+        :obj:`numpy:numpy.ndarray`: The dataset. If it came from or was added to
+        the cache it is a read-only view of shared memory.
+    """
+    if not (enabled() and is_current_shot(h5_path)):
+        return read()
+    name = _block_name(h5_path, dataset_path)
+    if name in _created:
+        return _as_array(_created[name])
+    if name in _attached:
+        return _as_array(_attached[name])
+    array = _attach(name)
+    if array is not None:
+        return array
+    data = read()
+    array = _publish(name, data)
+    if array is None:
+        return data
+    return array
+
+
+def release():
+    """Close all blocks this process has mapped, and unlink those it created.
+    Called by the analysis worker before it analyses a different shot. Blocks
+    still referenced by arrays the user has kept hold of are left open, and
+    closed on a subsequent call once the arrays are gone."""
+    for blocks in [_created, _attached]:
+        for name, shm in list(blocks.items()):
+            if blocks is _created:
+                try:
+                    shm.unlink()
+                except FileNotFoundError:
+                    pass
+            try:
+                shm.close()
+            except BufferError:
+                # Arrays still refer to the memory, try again next time:
+                continue
+            del blocks[name]
+
+
+atexit.register(release)
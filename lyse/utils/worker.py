@@ -30,6 +30,9 @@ Within lyse GUI, updated automatically to the correct path.
 """
 _updated_data = {}
 """Data to be sent back to the lyse GUI if running within lyse"""
+_shot_data = None
+"""The row of the lyse dataframe for the shot at `path`, as a flat dictionary,
+if sent by the lyse GUI along with the shot to be analysed"""
 _plot_classes = {}
 """Dictionary of plot id's to classes to use for Plot object"""
 Plot=object
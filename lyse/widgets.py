@@ -25,6 +25,21 @@ class UneditableModel(QtGui.QStandardItemModel):
         result = QtGui.QStandardItemModel.flags(self, index)
         return result & ~QtCore.Qt.ItemIsEditable
 
+class DataFrameItemModel(UneditableModel):
+    """An UneditableModel whose vertical header labels are computed on demand by
+    calling vertical_header_text(row_number), rather than being stored as one
+    QStandardItem per row that must be rewritten whenever rows are added or
+    removed."""
+
+    def __init__(self, vertical_header_text):
+        UneditableModel.__init__(self)
+        self.vertical_header_text = vertical_header_text
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Vertical and role == QtCore.Qt.DisplayRole:
+            return self.vertical_header_text(section)
+        return UneditableModel.headerData(self, section, orientation, role)
+
 class EditColumnsDialog(QtWidgets.QDialog):
     close_signal = Signal()
 
@@ -95,12 +110,29 @@ class TableView(QtWidgets.QTableView):
     click on a valid index, and doubleLeftClicked(index) (in addition) on
     double click. Multiple inheritance of QObjects is not possible, so we
     are forced to duplicate code instead of sharing code with the extremely
-    similar TreeView class in this module"""
+    similar TreeView class in this module.
+
+    If tooltip_function is set, tooltips are computed on demand by calling
+    tooltip_function(row, column) when the user hovers over a cell, falling back
+    to the item's own tooltip if it returns None. This avoids storing a tooltip
+    per item, without overriding the model's data() method, which Qt calls for
+    every role of every cell painted."""
 
     def __init__(self, *args):
         QtWidgets.QTableView.__init__(self, *args)
         self._pressed_index = None
         self._double_click = False
+        self.tooltip_function = None
+
+    def viewportEvent(self, event):
+        if event.type() == QtCore.QEvent.ToolTip and self.tooltip_function is not None:
+            index = self.indexAt(event.pos())
+            if index.isValid():
+                tooltip = self.tooltip_function(index.row(), index.column())
+                if tooltip is not None:
+                    QtWidgets.QToolTip.showText(event.globalPos(), tooltip, self.viewport(), self.visualRect(index))
+                    return True
+        return QtWidgets.QTableView.viewportEvent(self, event)
 
     def mousePressEvent(self, event):
         result = QtWidgets.QTableView.mousePressEvent(self, event)